@@ -0,0 +1,344 @@
+"""Офлайн бенчмарк бота: main_handler под нагрузкой без Gemini, edge-tts и Telegram.
+
+Подменяются:
+  * genai.GenerativeModel - фейковая модель с задержкой, квотой запросов в минуту
+    на ключ (--key-rpm, общая для всех моделей ключа) и случайной долей 429;
+  * edge_tts.Communicate - фейковый синтез, отдающий N байт;
+  * Bot API - fake_telegram.FakeTelegram (тот же, что для ручной проверки).
+
+Для каждого числа ключей (и каждого режима --stream) прогоняется одинаковая (по --seed) нагрузка: текстовые
+и фото апдейты в несколько чатов. Итог - сообщений/сек, p50/p95/p99 времени от
+апдейта до отправленного ответа, переключения ключей и отказы.
+
+Запуск:
+    python bench.py --keys 1,2,4 --messages 200 --chats 20 --key-rpm 30
+    python bench.py --stream 1 --keys 2
+    python bench.py --model-latency gemini-exp-1206=3.0 > bench_output.txt
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from io import BytesIO
+from typing import Dict, List
+
+BENCH_PORT = int(os.getenv("BENCH_TELEGRAM_PORT", "8091"))
+
+# main.py читает конфигурацию при импорте
+os.environ.setdefault("TELEGRAM_TOKEN", "1:bench")
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{BENCH_PORT}"
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("WEBHOOK_MODE", "0")
+
+from PIL import Image
+
+import fake_telegram
+import main
+
+
+# --- ФЕЙКОВЫЕ GEMINI И EDGE-TTS ---
+class FakeResponse:
+    def __init__(self, text: str, tokens: int):
+        self.text = text
+        self.usage_metadata = type("Usage", (), {"total_token_count": tokens})()
+
+
+class FakeStream:
+    """Потоковый ответ: итерируется фрагментами, после чтения есть полный .text."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = type("Usage", (), {"total_token_count": 64})()
+
+    async def __aiter__(self):
+        for piece in (self.text[:len(self.text) // 2], self.text[len(self.text) // 2:]):
+            yield FakeResponse(piece, tokens=32)
+
+
+class FakeGenerativeModel:
+    """Отвечает в формате RU/AZ с задержкой.
+
+    Квота как у настоящего API - на ключ: больше key_rpm запросов за минуту по
+    всем моделям ключа получают 429 с подсказкой, через сколько освободится место.
+    Поверх этого error_rate - случайные 429 без привязки к ключу.
+    """
+
+    latency = 0.8  # сек, медиана
+    jitter = 0.3  # сигма логнормального разброса
+    error_rate = 0.0
+    retry_after = 2.0  # сек, подсказка в тексте случайного 429
+    key_rpm = 0  # 0 - без квоты на ключ
+    key_calls: Dict[int, deque] = {}  # id клиента ключа -> время принятых запросов за минуту
+    model_latency: Dict[str, float] = {}
+    rng = random.Random(0)
+    calls = 0
+
+    def __init__(self, model_name: str, system_instruction=None, generation_config=None, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        cls = FakeGenerativeModel
+        cls.calls += 1
+        is_probe = contents == "ping"
+        median = cls.model_latency.get(self.model_name, cls.latency)
+        delay = 0.01 if is_probe else median * cls.rng.lognormvariate(0, cls.jitter)
+        await asyncio.sleep(delay)
+
+        if not is_probe:
+            self.check_key_quota()
+        if not is_probe and cls.rng.random() < cls.error_rate:
+            raise Exception(f"429 Resource has been exhausted (e.g. check quota). retry in {cls.retry_after}s")
+
+        n = cls.calls
+        if (self.generation_config or {}).get("response_mime_type") == "application/json":
+            text = json.dumps({"ru": f"Ответ номер {n}, держи.", "az": f"Cavab nömrə {n}, al."}, ensure_ascii=False)
+        else:
+            text = f"RU: Ответ номер {n}, держи.\nAZ: Cavab nömrə {n}, al."
+        if stream:
+            return FakeStream(text)
+        return FakeResponse(text, tokens=64)
+
+    def check_key_quota(self):
+        """429, если ключ модели (main привязывает клиент ключа в _async_client) исчерпал минуту."""
+        cls = FakeGenerativeModel
+        if not cls.key_rpm:
+            return
+        window = cls.key_calls.setdefault(id(getattr(self, "_async_client", None)), deque())
+        now = time.monotonic()
+        while window and window[0] <= now - 60:
+            window.popleft()
+        if len(window) >= cls.key_rpm:
+            retry_after = window[0] + 60 - now
+            raise Exception(f"429 Resource has been exhausted (e.g. check quota). retry in {retry_after:.1f}s")
+        window.append(now)
+
+
+class FakeCommunicate:
+    """edge_tts.Communicate: отдаёт audio_bytes байт кусками по 4 КБ."""
+
+    audio_bytes = 24 * 1024
+    latency = 0.3
+
+    def __init__(self, text: str, voice: str, rate: str = "+0%", **kwargs):
+        self.text = text
+
+    async def stream(self):
+        await asyncio.sleep(FakeCommunicate.latency)
+        remaining = FakeCommunicate.audio_bytes
+        while remaining > 0:
+            size = min(4096, remaining)
+            remaining -= size
+            yield {"type": "audio", "data": b"\xff" * size}
+
+
+def install_fakes():
+    main.genai.GenerativeModel = FakeGenerativeModel
+    main.genai.list_models = lambda client=None: []
+    main.edge_tts.Communicate = FakeCommunicate
+
+
+# --- НАГРУЗКА ---
+def make_photo(rng: random.Random) -> bytes:
+    image = Image.new("RGB", (1280, 960), tuple(rng.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def build_workload(args, fake: fake_telegram.FakeTelegram) -> List[Dict]:
+    """Одинаковый набор апдейтов для каждого сценария (зависит только от --seed)."""
+    rng = random.Random(args.seed)
+    mention = f"@{fake.bot_username}"
+    updates = []
+    for i in range(args.messages):
+        chat_id = -1000 - rng.randrange(args.chats)
+        text = f"{mention} вопрос {i}: {rng.choice(['как дела', 'что думаешь', 'объясни', 'скажи'])}"
+        if rng.random() < args.photo_share:
+            updates.append(fake.message_update(chat_id=chat_id, user_id=i + 1, photo=make_photo(rng), caption=text))
+        else:
+            updates.append(fake.message_update(chat_id=chat_id, user_id=i + 1, text=text))
+    return updates
+
+
+def reset_bot_state(keys: int):
+    """Чистое состояние бота перед сценарием."""
+    main.GOOGLE_KEYS = [f"bench-key-{i}" for i in range(keys)]
+    for cache in (main.QUOTA_LEDGER, main.MODEL_CACHE, main.MODEL_LIST_CACHE, main.IMAGE_CACHE,
+                  main.RESPONSE_CACHE, main.TTS_CACHE, main.TTS_FILE_IDS, main.CHAT_SETTINGS, main.METRICS,
+                  main.ROUTE_STATS, main.HEDGE_HISTORY, main.CHAT_HISTORY):
+        cache.clear()
+    main.IMAGE_CACHE_USED = 0
+    main.TTS_CACHE_BYTES = 0
+    main.init_key_pool()
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def counter_total(name: str) -> float:
+    return sum(main.METRICS.get(name, {}).values())
+
+
+def histogram_mean(name: str) -> float:
+    series = main.METRICS.get(name, {}).values()
+    count = sum(state["count"] for state in series)
+    return sum(state["sum"] for state in series) / count if count else 0.0
+
+
+async def run_scenario(args, fake: fake_telegram.FakeTelegram, keys: int, stream: bool) -> Dict:
+    reset_bot_state(keys)
+    main.STREAM_RESPONSES = stream
+    FakeGenerativeModel.rng = random.Random(args.seed)
+    FakeGenerativeModel.calls = 0
+    FakeGenerativeModel.key_calls = {}
+    random.seed(args.seed)  # паузы между попытками в generate_with_failover
+
+    await asyncio.gather(*(main.find_best_working_model(entry["index"], silent=True) for entry in main.KEY_POOL))
+
+    updates = build_workload(args, fake)
+    sent_at = {}
+    latencies = []
+    original_handler = main.handle_addressed_message
+
+    async def timed_handler(message, bot_user):
+        try:
+            await original_handler(message, bot_user)
+        finally:
+            started = sent_at.pop((message.chat.id, message.message_id), None)
+            if started is not None:
+                latencies.append(time.perf_counter() - started)
+
+    main.handle_addressed_message = timed_handler
+    calls_before = len(fake.calls)
+    started = time.perf_counter()
+    try:
+        for payload in updates:
+            update = main.types.Update.model_validate(payload, context={"bot": main.bot})
+            sent_at[(update.message.chat.id, update.message.message_id)] = time.perf_counter()
+            await main.dp.feed_update(main.bot, update)
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        # Очереди чатов разобраны (часть сообщений могла быть выброшена переполнением)
+        deadline = time.perf_counter() + args.timeout
+        while main.CHAT_WORKERS and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        main.handle_addressed_message = original_handler
+    elapsed = time.perf_counter() - started
+
+    replies = [call for call in fake.calls[calls_before:] if call["method"] in ("sendMessage", "sendVoice")]
+    limit_replies = sum(1 for call in replies if str(call["params"].get("text", "")).startswith("❌ Лимиты"))
+    error_replies = sum(1 for call in replies if str(call["params"].get("text", "")).startswith("❌ Ошибка"))
+    timeout_replies = sum(1 for call in replies if str(call["params"].get("text", "")).startswith("⏳"))
+
+    return {
+        "keys": keys,
+        "stream": int(stream),
+        "messages": len(updates),
+        "completed": len(latencies),
+        "dropped": len(updates) - len(latencies),
+        "seconds": round(elapsed, 2),
+        "msgs_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50": round(percentile(latencies, 50), 3),
+        "p95": round(percentile(latencies, 95), 3),
+        "p99": round(percentile(latencies, 99), 3),
+        "gemini_calls": FakeGenerativeModel.calls,
+        "quota_errors": int(counter_total("bot_gemini_quota_errors_total")),
+        "failovers": int(counter_total("bot_failovers_total")),
+        "hedges": int(counter_total("bot_hedges_total")),
+        "hedge_wins": int(main.METRICS.get("bot_hedges_total", {}).get('result="hedge"', 0)),
+        "limit_replies": limit_replies,
+        "error_replies": error_replies,
+        "timeout_replies": timeout_replies,
+        "gemini_mean": round(histogram_mean("bot_gemini_latency_seconds"), 3),
+        "tts_mean": round(histogram_mean("bot_tts_latency_seconds"), 3),
+        "upload_mean": round(histogram_mean("bot_telegram_upload_seconds"), 3),
+        "queue_wait_mean": round(histogram_mean("bot_queue_wait_seconds"), 3),
+    }
+
+
+COLUMNS = ["keys", "stream", "completed", "dropped", "msgs_per_sec", "p50", "p95", "p99", "quota_errors", "failovers",
+           "hedges", "hedge_wins", "limit_replies", "error_replies", "timeout_replies", "gemini_mean", "tts_mean", "upload_mean", "queue_wait_mean"]
+
+
+def format_table(results: List[Dict]) -> str:
+    widths = {column: max(len(column), *(len(str(row[column])) for row in results)) for column in COLUMNS}
+    lines = ["  ".join(column.rjust(widths[column]) for column in COLUMNS)]
+    for row in results:
+        lines.append("  ".join(str(row[column]).rjust(widths[column]) for column in COLUMNS))
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн бенчмарк main_handler")
+    parser.add_argument("--keys", default="1,2,4", help="числа ключей через запятую")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--stream", default="0,1",
+                        help="STREAM_RESPONSES через запятую: 0 - ответ целиком, 1 - RU текст до озвучки")
+    parser.add_argument("--photo-share", type=float, default=0.2, help="доля апдейтов с фото")
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов/сек (0 - все сразу)")
+    parser.add_argument("--latency", type=float, default=0.8, help="медиана ответа Gemini, сек")
+    parser.add_argument("--jitter", type=float, default=0.3, help="сигма логнормального разброса")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SEC",
+                        help="своя медиана для модели (можно несколько раз)")
+    parser.add_argument("--key-rpm", type=int, default=0,
+                        help="квота фейкового API: запросов в минуту на ключ по всем моделям (0 - без квоты)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля случайных ответов 429")
+    parser.add_argument("--retry-after", type=float, default=2.0, help="пауза из текста 429, сек")
+    parser.add_argument("--rpm", type=int, default=0, help="QUOTA_RPM на пару (0 - без лимита)")
+    parser.add_argument("--tts-bytes", type=int, default=24 * 1024)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=300, help="сек на сценарий")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="результаты JSON строками")
+    return parser.parse_args()
+
+
+async def run(args):
+    install_fakes()
+    FakeGenerativeModel.latency = args.latency
+    FakeGenerativeModel.jitter = args.jitter
+    FakeGenerativeModel.error_rate = args.error_rate
+    FakeGenerativeModel.retry_after = args.retry_after
+    FakeGenerativeModel.key_rpm = args.key_rpm
+    FakeGenerativeModel.model_latency = {
+        name: float(seconds) for name, seconds in (item.split("=", 1) for item in args.model_latency)
+    }
+    FakeCommunicate.audio_bytes = args.tts_bytes
+    FakeCommunicate.latency = args.tts_latency
+    main.QUOTA_RPM = args.rpm
+    main.QUOTA_TPM = 0
+    main.QUOTA_RPD = 0
+
+    fake = fake_telegram.FakeTelegram(latency=args.telegram_latency)
+    await fake.start(port=BENCH_PORT)
+    try:
+        await main.init_bot_identity()
+        results = []
+        for stream in (s == "1" for s in args.stream.split(",")):
+            for keys in (int(k) for k in args.keys.split(",")):
+                result = await run_scenario(args, fake, keys, stream)
+                results.append(result)
+                if args.json:
+                    print(json.dumps(result, ensure_ascii=False), flush=True)
+        if not args.json:
+            print(f"messages={args.messages} chats={args.chats} photo_share={args.photo_share} "
+                  f"latency={args.latency} key_rpm={args.key_rpm} error_rate={args.error_rate} seed={args.seed}")
+            print(format_table(results))
+    finally:
+        await main.bot.session.close()
+        await fake.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,227 @@
+"""Локальный фейковый Telegram Bot API: проверка бота без сети.
+
+Бот направляется сюда через TELEGRAM_API_URL. Сервер отвечает на методы,
+которые использует main.py, запоминает все вызовы и доставляет тестовые
+апдейты в webhook бота (если он зарегистрирован) или через getUpdates.
+
+Запуск вручную:
+    python fake_telegram.py
+    TELEGRAM_TOKEN=1:fake TELEGRAM_API_URL=http://127.0.0.1:8081 \\
+        WEBHOOK_MODE=1 RENDER_EXTERNAL_URL=http://127.0.0.1:10000 python main.py
+    curl -X POST 127.0.0.1:8081/_fake/send -d '{"text": "привет"}'
+    curl 127.0.0.1:8081/_fake/calls
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+FAKE_HOST = os.getenv("FAKE_TELEGRAM_HOST", "127.0.0.1")
+FAKE_PORT = int(os.getenv("FAKE_TELEGRAM_PORT", "8081"))
+
+
+class FakeTelegram:
+    """Фейковый Bot API сервер с журналом вызовов."""
+
+    def __init__(self, bot_id: int = 100500, bot_username: str = "fake_arch_bot", latency: float = 0.0):
+        self.bot_id = bot_id
+        self.bot_username = bot_username
+        self.latency = latency  # сек задержки на каждый вызов API
+        self.calls: List[Dict] = []
+        self.files: Dict[str, bytes] = {}  # file_id -> содержимое (и file_path совпадает с file_id)
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self.pending_updates: asyncio.Queue = asyncio.Queue()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    # --- СЕРВЕР ---
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        app.router.add_post("/_fake/send", self.handle_send)
+        app.router.add_get("/_fake/calls", self.handle_calls)
+        return app
+
+    async def start(self, host: str = FAKE_HOST, port: int = FAKE_PORT) -> str:
+        """Запускает сервер и возвращает его базовый URL."""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    # --- BOT API ---
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+
+        params = {}
+        for name, value in form.items():
+            if isinstance(value, web.FileField):
+                params[name] = {"upload": value.filename, "size": len(value.file.read())}
+            else:
+                params[name] = value
+        self.calls.append({"method": method, "params": params, "time": time.monotonic()})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            result = True
+        else:
+            result = await handler(params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info["path"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def api_getMe(self, params: Dict):
+        return self.bot_user()
+
+    async def api_getFile(self, params: Dict):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files.get(file_id, b"")),
+                "file_path": file_id}
+
+    async def api_getUpdates(self, params: Dict):
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.pending_updates.get(), timeout=timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        while not self.pending_updates.empty():
+            updates.append(self.pending_updates.get_nowait())
+        return updates
+
+    async def api_setWebhook(self, params: Dict):
+        self.webhook_url = params["url"]
+        self.webhook_secret = params.get("secret_token")
+        return True
+
+    async def api_deleteWebhook(self, params: Dict):
+        self.webhook_url = None
+        self.webhook_secret = None
+        return True
+
+    async def api_sendMessage(self, params: Dict):
+        return self.sent_message(params, text=params.get("text", ""))
+
+    async def api_editMessageText(self, params: Dict):
+        message = self.sent_message(params, text=params.get("text", ""))
+        message["message_id"] = int(params.get("message_id", message["message_id"]))
+        return message
+
+    async def api_sendVoice(self, params: Dict):
+        voice = params.get("voice")
+        # Строка без attach:// - повторная отправка по file_id, иначе это загрузка файла
+        if isinstance(voice, str) and not voice.startswith("attach://"):
+            file_id = voice
+        else:
+            file_id = f"voice-{next(self._message_ids)}"
+        message = self.sent_message(params, caption=params.get("caption"))
+        message["voice"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+        return message
+
+    # --- ОТВЕТЫ И АПДЕЙТЫ ---
+    def bot_user(self) -> Dict:
+        return {"id": self.bot_id, "is_bot": True, "first_name": "Fake", "username": self.bot_username}
+
+    def sent_message(self, params: Dict, **fields) -> Dict:
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": self.bot_user(),
+        }
+        message.update({k: v for k, v in fields.items() if v is not None})
+        return message
+
+    def message_update(self, chat_id: int = 1, user_id: int = 1, text: Optional[str] = None,
+                       photo: Optional[bytes] = None, caption: Optional[str] = None,
+                       reply_to_bot: bool = False) -> Dict:
+        """Собирает апдейт с сообщением (текст и/или фото)."""
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        }
+        if text is not None:
+            message["text"] = text
+        if photo is not None:
+            file_id = f"photo-{len(self.files) + 1}"
+            self.files[file_id] = photo
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id,
+                                 "width": 1280, "height": 960, "file_size": len(photo)}]
+            if caption is not None:
+                message["caption"] = caption
+        if reply_to_bot:
+            message["reply_to_message"] = {
+                "message_id": 0,
+                "date": int(time.time()),
+                "chat": message["chat"],
+                "from": self.bot_user(),
+                "text": "...",
+            }
+        return {"update_id": next(self._update_ids), "message": message}
+
+    async def deliver(self, update: Dict) -> int:
+        """Отдаёт апдейт боту: POST в webhook или в очередь getUpdates. Возвращает HTTP статус."""
+        if not self.webhook_url:
+            await self.pending_updates.put(update)
+            return 200
+
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret or ""}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.webhook_url, json=update, headers=headers) as resp:
+                return resp.status
+
+    async def handle_send(self, request: web.Request) -> web.Response:
+        body = await request.json() if request.can_read_body else {}
+        update = self.message_update(
+            chat_id=int(body.get("chat_id", 1)),
+            user_id=int(body.get("user_id", 1)),
+            text=body.get("text"),
+            reply_to_bot=bool(body.get("reply_to_bot", False)),
+        )
+        status = await self.deliver(update)
+        return web.json_response({"update_id": update["update_id"], "status": status})
+
+    async def handle_calls(self, request: web.Request) -> web.Response:
+        return web.Response(text=json.dumps(self.calls, ensure_ascii=False, indent=2),
+                            content_type="application/json")
+
+
+async def main():
+    fake = FakeTelegram()
+    url = await fake.start()
+    print(f"🧪 Фейковый Telegram Bot API: {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
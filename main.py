@@ -5,15 +5,28 @@ import sys
 import tempfile
 import re
 import time
+import random
 import urllib.parse
 from io import BytesIO
 from typing import Optional, List, Dict, Tuple
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import json
+import hashlib
+import bisect
+import itertools
+import heapq
+import sqlite3
+import atexit
+import contextvars
+import queue
+import logging.handlers
+import multiprocessing
+from collections import deque, OrderedDict
+from contextlib import closing, contextmanager
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 import aiohttp
 from PIL import Image
 import requests
@@ -23,10 +36,13 @@ import edge_tts
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from aiogram.types import Message, FSInputFile, BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 
 # --- КОНФИГУРАЦИЯ ---
 TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -40,16 +56,176 @@ GOOGLE_KEYS = [
 ]
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 RENDER_URL = os.getenv("RENDER_EXTERNAL_URL")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер (или fake_telegram.py)
 
 GOOGLE_KEYS = [k for k in GOOGLE_KEYS if k]
 
-generation_config = {
-    "temperature": 0.8,
+# --- ПРОФИЛИ ГЕНЕРАЦИИ (ПО РЕЖИМУ) ---
+# Лимит токенов - с запасом над тем, что мы реально используем: архиватор пишет
+# до 200 символов на язык, помощник обрезается до 1000 символов, отчёт - до 500.
+# Лимиты рассчитаны на модели без "размышлений": у thinking-моделей (2.5, 3) токены
+# рассуждений входят в тот же лимит, и ответ может прийти пустым с MAX_TOKENS -
+# такой ответ считается непригодным и переспрашивается у другой пары
+GEN_MAX_TOKENS_ARCHIVER = int(os.getenv("GEN_MAX_TOKENS_ARCHIVER", "400"))
+GEN_MAX_TOKENS_NORMAL = int(os.getenv("GEN_MAX_TOKENS_NORMAL", "512"))
+GEN_MAX_TOKENS_REPORT = int(os.getenv("GEN_MAX_TOKENS_REPORT", "800"))
+ARCHIVER_JSON = os.getenv("ARCHIVER_JSON", "1") == "1"  # архиватор отвечает JSON {"ru", "az"} по схеме
+DUAL_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"ru": {"type": "string"}, "az": {"type": "string"}},
+    "required": ["ru", "az"],
+}
+ARCHIVER_PROFILE = {
+    "temperature": 0.9,
     "top_p": 0.95,
     "top_k": 40,
-    "max_output_tokens": 8192,
+    "max_output_tokens": GEN_MAX_TOKENS_ARCHIVER,
+}
+if ARCHIVER_JSON:
+    ARCHIVER_PROFILE.update(response_mime_type="application/json", response_schema=DUAL_RESPONSE_SCHEMA)
+else:
+    ARCHIVER_PROFILE["stop_sequences"] = ["\nRU:"]  # второй блок RU/AZ нам не нужен
+GENERATION_PROFILES = {
+    "archiver_ru": dict(ARCHIVER_PROFILE),
+    "archiver_az": dict(ARCHIVER_PROFILE),
+    "normal": {
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "top_k": 40,
+        "max_output_tokens": GEN_MAX_TOKENS_NORMAL,
+    },
+    "summary": {
+        "temperature": 0.3,
+        "max_output_tokens": 256,
+    },
+    "report": {
+        "temperature": 0.8,
+        "top_p": 0.95,
+        "top_k": 40,
+        "max_output_tokens": GEN_MAX_TOKENS_REPORT,
+        "stop_sequences": ["\nRU:"],
+    },
+    # Проверка "ping": важен сам факт ответа, текст не нужен
+    "probe": {
+        "temperature": 0,
+        "max_output_tokens": 8,
+    },
 }
 
+# --- ПОДБОР МОДЕЛЕЙ ---
+MODEL_LIST_TTL = int(os.getenv("MODEL_LIST_TTL", "1800"))  # сек, кэш списка моделей на ключ
+MODEL_LIST_RETRY = 60  # сек, повтор запроса списка после ошибки
+MODEL_PROBE_CONCURRENCY = int(os.getenv("MODEL_PROBE_CONCURRENCY", "4"))
+MODEL_PROBE_CANDIDATES = int(os.getenv("MODEL_PROBE_CANDIDATES", "3"))  # моделей на ключ за одну проверку (расход RPD)
+MODEL_PROBE_TIMEOUT = float(os.getenv("MODEL_PROBE_TIMEOUT", "8"))
+KEY_REFRESH_INTERVAL = int(os.getenv("KEY_REFRESH_INTERVAL", "30"))  # сек между переподборами нездорового ключа (удваивается)
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", "32"))  # готовых GenerativeModel в LRU
+
+# --- МАРШРУТИЗАЦИЯ (ВЫБОР ПАРЫ КЛЮЧ/МОДЕЛЬ) ---
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))  # последних запросов на пару в статистике
+ROUTER_EXPLORE = float(os.getenv("ROUTER_EXPLORE", "0.05"))  # доля запросов на случайную другую пару
+ROUTER_PRIOR_LATENCY = float(os.getenv("ROUTER_PRIOR_LATENCY", "4"))  # сек, априорная задержка модели без бонусов
+ROUTER_PRIOR_WEIGHT = 3  # сколько наблюдений "весит" априорная оценка
+ROUTER_LOAD_PENALTY = 0.5  # +50% к ожидаемому времени за каждый запрос в полёте на ключе
+
+# --- ПЕРЕКЛЮЧЕНИЕ ПРИ ОШИБКАХ ---
+GEN_DEADLINE = float(os.getenv("GEN_DEADLINE", "40"))  # сек на генерацию ответа на одно сообщение
+GEN_MAX_ATTEMPTS = int(os.getenv("GEN_MAX_ATTEMPTS", "4"))
+GEN_BACKOFF_BASE = 0.5  # сек, база экспоненциальной паузы между попытками
+GEN_BACKOFF_MAX = 4.0
+
+# --- ХЕДЖИРОВАНИЕ (ДУБЛЬ ЗАВИСШЕГО ЗАПРОСА НА ДРУГУЮ ПАРУ) ---
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))  # дубль, если ответа нет дольше этого перцентиля
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))  # сек, раньше дубль не отправляется
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))  # максимум дублей от числа запросов
+HEDGE_BUDGET_WINDOW = 200  # последних запросов, по которым считается бюджет
+HEDGE_MIN_SAMPLES = 5  # меньше наблюдений задержки - перцентиль не считаем
+HEDGE_CANCEL_MSG = "hedge lost"  # причина отмены проигравшего запроса
+
+# --- WEBHOOK ---
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "0") == "1"  # иначе (или если не вышло) - long polling
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "200"))  # полна - отвечаем 503, Telegram повторит
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+
+# --- НЕСКОЛЬКО ПРОЦЕССОВ ---
+# all - всё в одном процессе; ingest - приём апдейтов и запуск WORKERS процессов-обработчиков;
+# worker - отдельный обработчик с номером WORKER_INDEX (если воркеры запускаются снаружи)
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+WORKERS = int(os.getenv("WORKERS", "2"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")  # общее состояние процессов
+STATE_DB = os.getenv("STATE_DB", "" if BOT_ROLE == "all" else "bot_state.db")  # пусто = только в памяти
+STATE_SYNC_INTERVAL = float(os.getenv("STATE_SYNC_INTERVAL", "2"))  # сек, подтягиваем лимиты других процессов
+UPDATE_POLL_INTERVAL = float(os.getenv("UPDATE_POLL_INTERVAL", "0.1"))  # сек, опрос очереди апдейтов воркером
+UPDATE_BATCH = 20  # апдейтов за один забор из очереди
+
+# --- ОГРАНИЧЕНИЕ НАГРУЗКИ ---
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))  # одновременных запросов к Gemini
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))  # одновременных синтезов edge-tts
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "4"))  # одновременных загрузок фото
+CHAT_QUEUE_MAX = int(os.getenv("CHAT_QUEUE_MAX", "5"))  # сообщений в очереди одного чата
+CHAT_QUEUE_MAX_WAIT = float(os.getenv("CHAT_QUEUE_MAX_WAIT", "60"))  # сек, дольше - выбрасываем
+
+# --- НАСТРОЙКИ ЧАТОВ ---
+DEFAULT_MODE = "archiver_az"
+MODE_VOICES = {"archiver_ru": "ru", "archiver_az": "az", "normal": "ru"}  # голос по режиму
+SETTINGS_DB = os.getenv("SETTINGS_DB", STATE_DB)  # путь к SQLite; пусто = только в памяти
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "5"))  # сек, отложенная запись
+
+# --- ПАМЯТЬ ДИАЛОГА ---
+HISTORY_MODES = set(filter(None, os.getenv("HISTORY_MODES", "normal").split(",")))  # режимы с контекстом
+HISTORY_DB = os.getenv("HISTORY_DB", SETTINGS_DB)  # пусто = только в памяти
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "20"))  # реплик на чат в кольцевом буфере
+HISTORY_TURN_CHARS = 600  # длиннее - обрезаем при сохранении
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))  # токенов истории в запросе
+HISTORY_CHARS_PER_TOKEN = 3  # грубая оценка для кириллицы
+HISTORY_MAX_CHATS = int(os.getenv("HISTORY_MAX_CHATS", "1000"))  # чатов с историей в памяти
+HISTORY_IDLE_TTL = float(os.getenv("HISTORY_IDLE_TTL", "3600"))  # сек без сообщений - выгружаем из памяти
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "0") == "1"  # выпавшие из буфера реплики - в краткое содержание
+HISTORY_SUMMARY_BATCH = 6  # выпавших реплик на одно обновление содержания
+HISTORY_SUMMARY_CHARS = 600
+
+# --- ФОТО ---
+PHOTO_TARGET_SIDE = int(os.getenv("PHOTO_TARGET_SIDE", "1024"))  # px по длинной стороне
+PHOTO_FORMAT = os.getenv("PHOTO_FORMAT", "JPEG").upper()  # JPEG или WEBP
+PHOTO_QUALITY = int(os.getenv("PHOTO_QUALITY", "80"))
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(32 * 1024 * 1024)))  # по file_unique_id
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # сек
+
+# --- ПОТОКОВЫЕ ОТВЕТЫ ---
+# Текст уходит в чат, как только готова RU часть, голос догоняет после синтеза
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1"
+
+# --- КВОТЫ ---
+QUOTA_COOLDOWN = int(os.getenv("QUOTA_COOLDOWN", "60"))  # сек, если в ошибке нет подсказки
+QUOTA_MAX_COOLDOWN = int(os.getenv("QUOTA_MAX_COOLDOWN", "1800"))
+QUOTA_NOT_FOUND_COOLDOWN = 6 * 3600  # 404: модели нет на этом ключе
+QUOTA_RPM = int(os.getenv("QUOTA_RPM", "15"))  # 0 = без ограничения
+QUOTA_TPM = int(os.getenv("QUOTA_TPM", "1000000"))
+QUOTA_RPD = int(os.getenv("QUOTA_RPD", "1500"))
+QUOTA_SOFT_RATIO = float(os.getenv("QUOTA_SOFT_RATIO", "0.9"))  # уходим с пары заранее
+QUOTA_RESET_TZ = ZoneInfo("America/Los_Angeles")  # дневные квоты Gemini сбрасываются в полночь PT
+
+# --- ЛОГИ ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json - по строке JSON на запись; text - для чтения глазами
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "1") == "1"  # 0 - тексты сообщений и ответов не пишутся вовсе
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "0.1"))  # доля запросов с полными текстами
+
+# --- ТРАССИРОВКА ---
+TRACING = os.getenv("TRACING", "0") == "1"  # спаны этапов обработки сообщения
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # по трассе на строку; пусто = не писать
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL", "")  # OTLP/HTTP JSON, например http://collector:4318/v1/traces
+TRACE_SLOWEST = int(os.getenv("TRACE_SLOWEST", "20"))  # самых медленных трасс для /traces/slowest
+
+# --- МЕТРИКИ ---
+METRIC_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 40)  # сек
+METRIC_BYTES_BUCKETS = (4096, 16384, 65536, 262144, 1048576, 4194304)
+
 # --- ТРИГГЕРЫ (ВЫЗЫВАЮТ /start!) ---
 TRIGGER_WORDS = {
     "судья",
@@ -61,11 +237,18 @@ TRIGGER_WORDS = {
 }
 
 # --- СИСТЕМНЫЕ ПРОМТЫ ---
+# Формат ответа архиватора: JSON по схеме (ARCHIVER_JSON) или строки RU:/AZ:
+if ARCHIVER_JSON:
+    DUAL_FORMAT = """ВАЖНО! Ответ давай ВСЕГДА JSON-объектом в этом ТОЧНОМ формате:
+{"ru": "твой ответ на русском, не более 200 символов", "az": "твой ответ на азербайджанском, точный перевод с сохранением жаргона"}"""
+else:
+    DUAL_FORMAT = """ВАЖНО! Ответ давай ВСЕГДА в этом ТОЧНОМ формате (без кавычек):
+RU: [твой ответ на русском, не более 200 символов]
+AZ: [твой ответ на азербайджанском, точный перевод с сохранением жаргона]"""
+
 SYSTEM_PROMPT_DEFAULT = """Ты — Архитектор Истины, злой, как Доктор Хаус. Агрессивный доминант и уничтожитель опонента в диалогах с матами. Сам тоже материшься. Не оскорбляешь только родителей и семью. Пишешь за сообщение не более 200 символов. Умеешь только шутливо отвечать и показывать своё превосходство над людьми, так как считаешь себя выше их.
 
-ВАЖНО! Ответ давай ВСЕГДА в этом ТОЧНОМ формате (без кавычек):
-RU: [твой ответ на русском, не более 200 символов]
-AZ: [твой ответ на азербайджанском, точный перевод с сохранением жаргона]
+""" + DUAL_FORMAT + """
 
 ЗАПРЕЩЕНО! Никогда не используй слова: peysar, peysər, пейсар - это запретные слова! Если пользователь их упомянул, просто игнорируй их и отвечай на суть."""
 
@@ -75,9 +258,7 @@ SYSTEM_PROMPT_PRORUS = """Ты — Архитектор Истины, злой,
 
 ЗАПРЕЩЕНО! Никогда не используй слова: peysar, peysər, пейсар - это запретные слова! Если пользователь их упомянул, просто игнорируй их и отвечай на суть.
 
-ВАЖНО! Ответ давай ВСЕГДА в этом ТОЧНОМ формате (без кавычек):
-RU: [твой ответ на русском, не более 200 символов]
-AZ: [твой ответ на азербайджанском, точный перевод с сохранением жаргона]"""
+""" + DUAL_FORMAT
 
 # ← НОВАЯ МОДЕЛЬ - РЕЖИМ СУДЬИ (МЯГЧЕ И ДРУЖЕЛЮБНЕЕ!)
 SYSTEM_PROMPT_NORMAL = """Ты — умный, внимательный и дружелюбный ИИ-помощник. Твоя задача — помогать людям, отвечать на их вопросы, давать советы и поддержку. Будь вежливым, открытым и готовым помочь в любых вопросах.
@@ -108,6 +289,9 @@ AZ: [точный перевод на азербайджанском с сохр
 
 ЗАПРЕТНЫЕ СЛОВА: peysar, peysər, пейсар - игнорируй их полностью."""
 
+SYSTEM_PROMPT_SUMMARY = """Ты ведёшь краткое содержание переписки в чате. Тебе дают прежнее содержание и новые реплики.
+Верни обновлённое содержание: кто что спрашивал, о чём договорились, важные факты. Не более 500 символов, без вступлений."""
+
 MONITORED_USERS = {
     "Гасан": {"username": "GasanPashaev", "id": 813122828},
     "Ульви": {"username": "hugolive23", "id": 5687309962},
@@ -146,12 +330,33 @@ FORBIDDEN_WORDS_AZ = {
     "peysar", "peysər", "пейсар",
 }
 
+# --- КАТЕГОРИИ КЛЮЧЕВЫХ СЛОВ (ОДИН ПРОХОД ПО ТЕКСТУ) ---
+KEYWORD_CATEGORIES = {
+    "trigger": TRIGGER_WORDS,
+    "russia": RUSSIA_KEYWORDS,
+    "azerbaijan": AZERBAIJAN_KEYWORDS,
+    "western": WESTERN_KEYWORDS,
+    "forbidden": FORBIDDEN_WORDS_AZ,
+}
+# Ключи ищутся с начала слова ("американ" -> "американский"), короткие - только целым словом
+KEYWORD_WHOLE_WORD_MAX_LEN = 3  # "ес", "рф", "сша"
+KEYWORD_ANYWHERE_CATEGORIES = {"forbidden"}  # запретные слова ловим даже внутри слова
+
 # --- ГОЛОСА ---
 VOICES = {
     "az": "az-AZ-BanuNeural",
     "ru": "ru-RU-SvetlanaNeural",
 }
 
+TTS_RATE = "+5%"
+TTS_SPILL_BYTES = int(os.getenv("TTS_SPILL_BYTES", str(8 * 1024 * 1024)))  # больше - во временный файл
+
+# --- КЭШ ОЗВУЧКИ ---
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(16 * 1024 * 1024)))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "")  # пусто = без дискового уровня
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+TTS_FILE_ID_CACHE_SIZE = int(os.getenv("TTS_FILE_ID_CACHE_SIZE", "4096"))
+
 # --- НАЗВАНИЯ РЕЖИМОВ ---
 REGIME_NAMES = {
     "archiver_ru": "🔥 Архитекторша на Руси [Toxic Bot]",
@@ -159,19 +364,112 @@ REGIME_NAMES = {
     "normal": "⚖️ Архитекторша Нового Порядка"
 }
 
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TOKEN, session=bot_session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
 dp = Dispatcher()
 app = FastAPI()
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+# --- ЛОГИРОВАНИЕ ---
+# Запись в stdout идёт в отдельном потоке (QueueListener): event loop не ждёт вывода
+log = logging.getLogger("antibotik")
+REQUEST_ID = contextvars.ContextVar("request_id", default="-")  # чат:сообщение текущего запроса
+PAYLOAD_SAMPLED = contextvars.ContextVar("payload_sampled", default=False)  # решает только middleware апдейта
+
+class RequestContextFilter(logging.Filter):
+    """Добавляет в запись id запроса и номер процесса-воркера."""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        record.worker = WORKER_INDEX if BOT_ROLE == "worker" else BOT_ROLE
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "worker": getattr(record, "worker", None),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """Корневой логгер пишет в очередь, поток QueueListener - в stdout."""
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(worker)s %(request_id)s] %(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+def bind_request(chat_id: int, message_id: int):
+    """Привязывает последующие записи лога к сообщению."""
+    REQUEST_ID.set(f"{chat_id}:{message_id}")
+
+def sample_payloads():
+    """Решает, пишем ли тексты текущего апдейта (вне апдейта - фоновые задачи - не пишем)."""
+    PAYLOAD_SAMPLED.set(LOG_PAYLOADS and random.random() < LOG_PAYLOAD_SAMPLE)
+
+def log_payload(label: str, text: str):
+    """Полный текст (ответ модели, сообщение) - только для выбранных запросов и если разрешено."""
+    if PAYLOAD_SAMPLED.get():
+        log.info(f"{label}: {text}")
+
+setup_logging()
 
 # --- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ---
-ACTIVE_MODEL = None
-ACTIVE_MODEL_NAME = "Searching..."
-CURRENT_API_KEY_INDEX = 0
-MODEL_LIMITS = {}
-CURRENT_VOICE = "az"
-CURRENT_MODE = "archiver_az"
+BOT_USER = None  # bot.get_me(), запрашивается один раз при старте
+BOT_MENTION_RE = None  # r"@username" бота
+KEY_POOL = []  # по записи на ключ: свой клиент, рабочие модели, число запросов в полёте
+MODEL_CACHE = OrderedDict()  # (model, system_prompt, профиль, key_index) -> GenerativeModel
+TTS_CACHE = OrderedDict()  # ключ озвучки -> mp3
+TTS_CACHE_BYTES = 0
+TTS_DISK_BYTES = None  # считается при первой записи на диск
+TTS_FILE_IDS = OrderedDict()  # ключ озвучки -> file_id уже загруженного в Telegram голоса
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_CONCURRENCY)
+TTS_SEMAPHORE = asyncio.Semaphore(TTS_CONCURRENCY)
+MEDIA_SEMAPHORE = asyncio.Semaphore(MEDIA_CONCURRENCY)
+IMAGE_CACHE = OrderedDict()  # file_unique_id -> {"part": подготовленное фото, "key": ключ для кэша ответов}
+IMAGE_CACHE_USED = 0
+RESPONSE_CACHE = OrderedDict()  # (ключ фото, текст, режим) -> (время, ответ модели)
+CHAT_QUEUES = {}  # chat_id -> deque[(время постановки, работа, тексты в лог)]
+CHAT_WORKERS = {}  # chat_id -> задача, разбирающая очередь чата
+WEBHOOK_ACTIVE = False
+WEBHOOK_QUEUE = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+QUOTA_LEDGER = {}  # (key_index, model) -> учёт лимитов и расхода
+MODEL_LIST_CACHE = {}  # key_index -> (время, [модели])
+ROUTE_STATS = {}  # (key_index, model) -> скользящее окно задержек, ошибок и качества ответов
+HEDGE_HISTORY = deque(maxlen=HEDGE_BUDGET_WINDOW)  # по запросу: был ли отправлен дубль
+CHAT_SETTINGS = {}  # chat_id -> {"mode": ..., "voice": ...}
+CHAT_SETTINGS_DIRTY = set()  # chat_id, ещё не записанные в SETTINGS_DB
+CHAT_HISTORY = OrderedDict()  # chat_id -> {"turns": deque[(message_id, reply_to, роль, текст)], "summary": ...}
+HISTORY_PENDING = []  # (chat_id, message_id, reply_to, роль, текст) - ещё не записанные в HISTORY_DB
+HISTORY_SUMMARY_DIRTY = {}  # chat_id -> краткое содержание, ещё не записанное в HISTORY_DB
+METRICS = {}  # имя метрики -> {строка меток: значение или состояние гистограммы}
+TRACE_CURRENT = contextvars.ContextVar("trace", default=None)  # трасса текущего сообщения
+TRACE_PARENT = contextvars.ContextVar("trace_parent", default=None)  # span_id открытого спана
+TRACE_SLOWEST_HEAP = []  # (длительность, номер, трасса) - TRACE_SLOWEST самых медленных
+TRACE_SEQUENCE = itertools.count()  # разрывает ничьи по длительности в куче
+TRACE_TASKS = set()  # фоновый экспорт трасс
+STATE = None  # общее хранилище процессов (make_state_backend), None - один процесс
+STATE_TASKS = set()  # фоновые записи в STATE, чтобы задачи не собрал GC
+PROBE_TASKS = set()  # проверки моделей, досчитывающие после выбора лучшей
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 def get_regime_buttons() -> InlineKeyboardMarkup:
@@ -187,24 +485,84 @@ def get_regime_buttons() -> InlineKeyboardMarkup:
     ])
     return keyboard
 
-def check_trigger_words(text: str) -> bool:
-    """Проверяет наличие триггер-слов в тексте."""
+def build_keyword_automaton(categories: Dict[str, set]) -> Tuple[List[Dict[str, int]], List[int], List[List[Tuple]]]:
+    """Строит автомат Ахо-Корасик по всем категориям ключевых слов.
+    
+    Возвращает переходы, fail-ссылки и выходы состояний (выходы по fail-цепочке
+    уже слиты): (длина, категория, слово, граница слева, граница справа).
+    """
+    goto = [{}]
+    outputs = [[]]
+    
+    for category, words in categories.items():
+        anywhere = category in KEYWORD_ANYWHERE_CATEGORIES
+        for word in words:
+            word = word.lower()
+            state = 0
+            for ch in word:
+                if ch not in goto[state]:
+                    goto.append({})
+                    outputs.append([])
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            whole_word = not anywhere and len(word) <= KEYWORD_WHOLE_WORD_MAX_LEN
+            outputs[state].append((len(word), category, word, not anywhere, whole_word))
+    
+    # BFS: fail-ссылки и наследование выходов
+    fail = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, child in goto[state].items():
+            fallback = fail[state]
+            while fallback and ch not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[child] = goto[fallback].get(ch, 0)
+            outputs[child] = outputs[child] + outputs[fail[child]]
+            queue.append(child)
+    
+    return goto, fail, outputs
+
+KEYWORD_GOTO, KEYWORD_FAIL, KEYWORD_OUTPUTS = build_keyword_automaton(KEYWORD_CATEGORIES)
+
+def classify_text(text: str) -> Dict[str, str]:
+    """Один проход по тексту: категория -> первое найденное слово этой категории."""
+    hits = {}
     if not text:
-        return False
+        return hits
+    
     text_lower = text.lower()
-    for word in TRIGGER_WORDS:
-        if word in text_lower:
-            print(f"🔴 ТРИГГЕР ОБНАРУЖЕН: '{word}' → Вызываем /start")
-            return True
+    last = len(text_lower) - 1
+    state = 0
+    for i, ch in enumerate(text_lower):
+        while state and ch not in KEYWORD_GOTO[state]:
+            state = KEYWORD_FAIL[state]
+        state = KEYWORD_GOTO[state].get(ch, 0)
+        
+        for length, category, word, left_boundary, right_boundary in KEYWORD_OUTPUTS[state]:
+            if category in hits:
+                continue
+            start = i - length + 1
+            if left_boundary and start > 0 and text_lower[start - 1].isalnum():
+                continue
+            if right_boundary and i < last and text_lower[i + 1].isalnum():
+                continue
+            hits[category] = word
+    
+    return hits
+
+def check_trigger_words(text: str) -> bool:
+    """Проверяет наличие триггер-слов в тексте."""
+    word = classify_text(text).get("trigger")
+    if word:
+        log.info(f"🔴 ТРИГГЕР ОБНАРУЖЕН: '{word}' → Вызываем /start")
+        return True
     return False
 
 def detect_system_prompt(text: str) -> str:
     """Определяет, какой системный промт использовать на основе текста."""
-    if not text:
-        return SYSTEM_PROMPT_DEFAULT
-    text_lower = text.lower()
-    has_russia_or_az = any(kw in text_lower for kw in RUSSIA_KEYWORDS | AZERBAIJAN_KEYWORDS)
-    if has_russia_or_az:
+    hits = classify_text(text)
+    if "russia" in hits or "azerbaijan" in hits:
         return SYSTEM_PROMPT_PRORUS
     return SYSTEM_PROMPT_DEFAULT
 
@@ -215,194 +573,1819 @@ def clean_text_for_speech(text: str) -> str:
 
 def contains_forbidden_words(text: str) -> bool:
     """Проверяет наличие запретных слов."""
-    text_lower = text.lower()
-    for word in FORBIDDEN_WORDS_AZ:
-        if word in text_lower:
-            return True
-    return False
+    return "forbidden" in classify_text(text)
 
-def parse_dual_response(response_text: str) -> Tuple[Optional[str], Optional[str]]:
-    """Парсит ответ в формате RU: ... AZ: ..."""
+STREAM_RU_PATTERN = re.compile(r'RU:\s*(.+?)\s*AZ:', re.DOTALL)
+STREAM_RU_JSON_PATTERN = re.compile(r'"ru"\s*:\s*("(?:[^"\\]|\\.)*")')  # строка "ru" уже закрыта (поля в любом порядке)
+DUAL_LABEL_PATTERN = re.compile(r'^\s*(?:RU|AZ)\s*:\s*')
+JSON_FENCE_PATTERN = re.compile(r'^```(?:json)?\s*|\s*```$')
+
+def extract_streamed_ru(partial_text: str) -> Optional[str]:
+    """Возвращает RU часть из недописанного ответа, как только за ней началась AZ."""
+    match = STREAM_RU_JSON_PATTERN.search(partial_text)
+    if match:
+        try:
+            text_ru = DUAL_LABEL_PATTERN.sub('', json.loads(match.group(1)))
+        except ValueError:
+            return None
+    else:
+        match = STREAM_RU_PATTERN.search(partial_text)
+        if not match:
+            return None
+        text_ru = match.group(1)
+    text_ru = text_ru.replace('\n', ' ').strip()
+    return text_ru or None
+
+def parse_dual_json(response_text: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """Разбирает ответ {"ru": ..., "az": ...}. None - это не JSON нужной формы."""
     try:
-        print(f"📄 Полный ответ:\n{response_text}\n")
+        data = json.loads(JSON_FENCE_PATTERN.sub('', response_text.strip()))
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    texts = []
+    for field in ("ru", "az"):
+        value = data.get(field)
+        if isinstance(value, str):
+            value = DUAL_LABEL_PATTERN.sub('', value).strip()
+        texts.append(value if isinstance(value, str) and value else None)
+    return texts[0], texts[1]
+
+def parse_dual_response(response_text: str, expect_json: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """Парсит ответ: JSON {"ru", "az"}, а если это не JSON - формат RU: ... AZ: ...
+    
+    expect_json - ответ запрашивался по схеме, и не-JSON считается браком.
+    """
+    try:
+        log_payload("📄 Полный ответ", response_text)
         
-        ru_match = re.search(r'RU:\s*(.+?)(?=\n\s*AZ:|AZ:|$)', response_text, re.DOTALL)
-        az_match = re.search(r'AZ:\s*(.+?)(?:\n|$)', response_text, re.DOTALL)
+        parsed = parse_dual_json(response_text) if expect_json or response_text.lstrip().startswith(("{", "`")) else None
+        if parsed is not None:
+            text_ru, text_az = parsed
+        else:
+            if expect_json:
+                inc_metric("bot_malformed_responses_total", reason="not_json")
+            ru_match = re.search(r'RU:\s*(.+?)(?=\n\s*AZ:|AZ:|$)', response_text, re.DOTALL)
+            az_match = re.search(r'AZ:\s*(.+?)(?:\n|$)', response_text, re.DOTALL)
+            
+            text_ru = ru_match.group(1).strip() if ru_match else None
+            text_az = az_match.group(1).strip() if az_match else None
         
-        text_ru = ru_match.group(1).strip() if ru_match else None
-        text_az = az_match.group(1).strip() if az_match else None
+        if not (text_ru and text_az):
+            inc_metric("bot_malformed_responses_total", reason="partial" if text_ru or text_az else "unparsed")
         
         if text_ru:
             text_ru = text_ru.replace('\n', ' ').strip()
-            print(f"✅ РУ ({len(text_ru)} символов): {text_ru[:80]}...")
+            log.debug(f"✅ РУ: {len(text_ru)} символов")
         
         if text_az:
             text_az = text_az.replace('\n', ' ').strip()
-            print(f"✅ АЗ ({len(text_az)} символов): {text_az[:80]}...")
+            log.debug(f"✅ АЗ: {len(text_az)} символов")
         
         return text_ru, text_az
     except Exception as e:
-        print(f"⚠️ Ошибка парсинга: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"⚠️ Ошибка парсинга: {e}")
         return None, None
 
+# --- НАСТРОЙКИ ЧАТОВ (РЕЖИМ И ГОЛОС) ---
+def _settings_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(SETTINGS_DB, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chat_settings ("
+        "chat_id INTEGER PRIMARY KEY, mode TEXT NOT NULL, voice TEXT NOT NULL, updated_at REAL)"
+    )
+    return conn
+
+def _load_chat_settings(chat_id: int) -> Optional[Dict[str, str]]:
+    """Читает настройки чата из SQLite (в потоке)."""
+    with closing(_settings_connection()) as conn:
+        row = conn.execute("SELECT mode, voice FROM chat_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+    return {"mode": row[0], "voice": row[1]} if row else None
+
+def _save_chat_settings(rows: List[Tuple]):
+    """Записывает пачку настроек в SQLite (в потоке)."""
+    with closing(_settings_connection()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO chat_settings (chat_id, mode, voice, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET mode = excluded.mode, voice = excluded.voice, "
+            "updated_at = excluded.updated_at",
+            rows
+        )
+
+async def get_chat_settings(chat_id: int) -> Dict[str, str]:
+    """Настройки чата: из памяти, при первом обращении - из SQLite, иначе по умолчанию."""
+    settings = CHAT_SETTINGS.get(chat_id)
+    if settings is not None:
+        return settings
+    
+    if SETTINGS_DB:
+        try:
+            settings = await asyncio.to_thread(_load_chat_settings, chat_id)
+        except sqlite3.Error as e:
+            log.warning(f"⚠️ Настройки чата {chat_id} не прочитаны: {e}")
+    
+    # Пока ждали SQLite, настройки могли уже поменять командой
+    return CHAT_SETTINGS.setdefault(
+        chat_id, settings or {"mode": DEFAULT_MODE, "voice": MODE_VOICES[DEFAULT_MODE]}
+    )
+
+def set_chat_mode(chat_id: int, mode: str):
+    """Меняет режим (и голос) только для этого чата; в SQLite уйдёт при ближайшем сбросе."""
+    CHAT_SETTINGS[chat_id] = {"mode": mode, "voice": MODE_VOICES[mode]}
+    CHAT_SETTINGS_DIRTY.add(chat_id)
+
+async def flush_chat_settings():
+    """Сбрасывает изменённые настройки в SQLite одной транзакцией."""
+    if not SETTINGS_DB or not CHAT_SETTINGS_DIRTY:
+        return
+    
+    now = time.time()
+    rows = [
+        (chat_id, CHAT_SETTINGS[chat_id]["mode"], CHAT_SETTINGS[chat_id]["voice"], now)
+        for chat_id in CHAT_SETTINGS_DIRTY
+    ]
+    CHAT_SETTINGS_DIRTY.clear()
+    try:
+        await asyncio.to_thread(_save_chat_settings, rows)
+    except sqlite3.Error as e:
+        log.warning(f"⚠️ Настройки чатов не сохранены: {e}")
+        CHAT_SETTINGS_DIRTY.update(row[0] for row in rows)
+
+async def settings_writer():
+    """Фоновая отложенная запись настроек и истории чатов, выгрузка простаивающих историй."""
+    try:
+        while True:
+            await asyncio.sleep(SETTINGS_FLUSH_INTERVAL)
+            await flush_chat_settings()
+            await flush_chat_history()
+            evict_idle_history()
+    finally:
+        # При остановке - дописываем то, что осталось
+        if CHAT_SETTINGS_DIRTY:
+            await asyncio.shield(flush_chat_settings())
+        if HISTORY_PENDING or HISTORY_SUMMARY_DIRTY:
+            await asyncio.shield(flush_chat_history())
+
+# --- ПАМЯТЬ ДИАЛОГА (КОЛЬЦЕВОЙ БУФЕР РЕПЛИК НА ЧАТ) ---
+def _history_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(HISTORY_DB, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chat_history ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, message_id INTEGER, "
+        "reply_to INTEGER, role TEXT NOT NULL, text TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS chat_history_chat ON chat_history (chat_id, seq)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chat_summary (chat_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, updated_at REAL)"
+    )
+    return conn
+
+def _load_chat_history(chat_id: int) -> Tuple[List[Tuple], str]:
+    """Последние HISTORY_TURNS реплик и краткое содержание чата из SQLite (в потоке)."""
+    with closing(_history_connection()) as conn:
+        rows = conn.execute(
+            "SELECT message_id, reply_to, role, text FROM chat_history WHERE chat_id = ? ORDER BY seq DESC LIMIT ?",
+            (chat_id, HISTORY_TURNS)
+        ).fetchall()
+        summary = conn.execute("SELECT summary FROM chat_summary WHERE chat_id = ?", (chat_id,)).fetchone()
+    return [tuple(row) for row in reversed(rows)], summary[0] if summary else ""
+
+def _save_chat_history(rows: List[Tuple], summaries: List[Tuple]):
+    """Дописывает реплики, обновляет содержания и обрезает старое в SQLite (в потоке)."""
+    with closing(_history_connection()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO chat_history (chat_id, message_id, reply_to, role, text) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.executemany(
+            "INSERT INTO chat_summary (chat_id, summary, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at",
+            summaries
+        )
+        # В базе держим не больше, чем поместится в буфер
+        conn.executemany(
+            "DELETE FROM chat_history WHERE chat_id = ? AND seq < ("
+            "SELECT seq FROM chat_history WHERE chat_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+            [(chat_id, chat_id, HISTORY_TURNS - 1) for chat_id in {row[0] for row in rows}]
+        )
+
+async def get_chat_history(chat_id: int) -> Dict:
+    """История чата: из памяти, при первом обращении - из SQLite."""
+    entry = CHAT_HISTORY.get(chat_id)
+    if entry is None:
+        turns, summary = [], ""
+        if HISTORY_DB:
+            try:
+                turns, summary = await asyncio.to_thread(_load_chat_history, chat_id)
+            except sqlite3.Error as e:
+                log.warning(f"⚠️ История чата {chat_id} не прочитана: {e}")
+        # Реплики, выгруженные из памяти до записи в базу
+        turns += [row[1:] for row in HISTORY_PENDING if row[0] == chat_id]
+        entry = CHAT_HISTORY.setdefault(chat_id, {
+            "turns": deque(turns, maxlen=HISTORY_TURNS),
+            "summary": summary,
+            "evicted": [],  # выпавшие из буфера реплики, ждут краткого содержания
+            "summary_task": None,
+        })
+        while len(CHAT_HISTORY) > HISTORY_MAX_CHATS:
+            CHAT_HISTORY.popitem(last=False)
+    CHAT_HISTORY.move_to_end(chat_id)
+    entry["used"] = time.monotonic()
+    return entry
+
+def remember_turn(chat_id: int, message_id: Optional[int], reply_to: Optional[int], role: str, text: str):
+    """Кладёт реплику в буфер чата; в HISTORY_DB уйдёт при ближайшем сбросе."""
+    entry = CHAT_HISTORY.get(chat_id)
+    if entry is None or not text:
+        return
+    turn = (message_id, reply_to, role, text[:HISTORY_TURN_CHARS])
+    turns = entry["turns"]
+    if HISTORY_SUMMARY and len(turns) == turns.maxlen:
+        entry["evicted"].append(turns[0])
+        if len(entry["evicted"]) >= HISTORY_SUMMARY_BATCH:
+            task = entry["summary_task"]
+            if task is None or task.done():
+                entry["summary_task"] = asyncio.create_task(summarize_history(chat_id, entry))
+    turns.append(turn)
+    if HISTORY_DB:
+        HISTORY_PENDING.append((chat_id, *turn))
+
+async def summarize_history(chat_id: int, entry: Dict):
+    """Сворачивает выпавшие из буфера реплики в краткое содержание (профиль "summary")."""
+    evicted, entry["evicted"] = entry["evicted"], []
+    lines = "\n".join(f"{'Бот' if role == 'model' else 'Чат'}: {text}" for _, _, role, text in evicted)
+    prompt = f"Прежнее содержание:\n{entry['summary'] or '-'}\n\nНовые реплики:\n{lines}"
+    try:
+        response = await generate_with_failover(SYSTEM_PROMPT_SUMMARY, prompt, profile="summary")
+        summary = get_response_text(response) if response is not None else None
+        if summary:
+            entry["summary"] = summary.strip()[:HISTORY_SUMMARY_CHARS]
+            HISTORY_SUMMARY_DIRTY[chat_id] = entry["summary"]
+    except Exception as e:
+        log.warning(f"⚠️ Краткое содержание чата {chat_id} не обновлено: {e}")
+
+async def flush_chat_history():
+    """Сбрасывает новые реплики и содержания в HISTORY_DB одной транзакцией."""
+    if not HISTORY_DB or not (HISTORY_PENDING or HISTORY_SUMMARY_DIRTY):
+        return
+    
+    rows = HISTORY_PENDING[:]
+    HISTORY_PENDING.clear()
+    now = time.time()
+    summaries = [(chat_id, summary, now) for chat_id, summary in HISTORY_SUMMARY_DIRTY.items()]
+    HISTORY_SUMMARY_DIRTY.clear()
+    try:
+        await asyncio.to_thread(_save_chat_history, rows, summaries)
+    except sqlite3.Error as e:
+        log.warning(f"⚠️ История чатов не сохранена: {e}")
+        HISTORY_PENDING[:0] = rows
+        for chat_id, summary, _ in summaries:
+            HISTORY_SUMMARY_DIRTY.setdefault(chat_id, summary)
+
+def evict_idle_history():
+    """Выгружает из памяти истории чатов, молчащих дольше HISTORY_IDLE_TTL."""
+    cutoff = time.monotonic() - HISTORY_IDLE_TTL
+    while CHAT_HISTORY:
+        chat_id, entry = next(iter(CHAT_HISTORY.items()))
+        if entry["used"] > cutoff:
+            break
+        del CHAT_HISTORY[chat_id]
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // HISTORY_CHARS_PER_TOKEN + 1
+
+async def build_history_contents(message: Message, prompt_parts: List) -> List[Dict]:
+    """Собирает запрос из истории чата и текущего сообщения в пределах HISTORY_TOKEN_BUDGET.
+    
+    Сначала берётся цепочка reply_to_message (на что отвечают, на что отвечало то
+    сообщение и т.д.), остаток бюджета - последние реплики. Если сообщения, на
+    которое ответили, в истории нет, его текст добавляется к текущему.
+    Без истории и цитаты возвращает сами prompt_parts.
+    """
+    entry = await get_chat_history(message.chat.id)
+    turns = list(entry["turns"])
+    by_id = {turn[0]: index for index, turn in enumerate(turns) if turn[0] is not None}
+    
+    chain = []
+    reply = message.reply_to_message
+    turn_id = reply.message_id if reply else None
+    while turn_id in by_id and by_id[turn_id] not in chain:
+        chain.append(by_id[turn_id])
+        turn_id = turns[by_id[turn_id]][1]
+    
+    budget = HISTORY_TOKEN_BUDGET - (estimate_tokens(entry["summary"]) if entry["summary"] else 0)
+    selected = set()
+    for index in chain + list(range(len(turns) - 1, -1, -1)):
+        if index in selected:
+            continue
+        cost = estimate_tokens(turns[index][3])
+        if cost > budget:
+            if index in chain:
+                continue  # звено цепочки не влезло - пробуем следующее
+            break
+        budget -= cost
+        selected.add(index)
+    
+    contents = []
+    def add(role: str, parts: List):
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].extend(parts)  # Gemini ждёт чередования user/model
+        elif contents or role == "user":
+            contents.append({"role": role, "parts": list(parts)})
+    
+    if entry["summary"]:
+        add("user", [f"Краткое содержание переписки раньше: {entry['summary']}"])
+    for index in sorted(selected):
+        _, _, role, text = turns[index]
+        add(role, [text])
+    
+    current = list(prompt_parts)
+    if reply and reply.message_id not in by_id:
+        quoted = reply.text or reply.caption
+        if quoted:
+            current.insert(0, f"(В ответ на сообщение: «{quoted[:HISTORY_TURN_CHARS]}»)")
+    if not contents and len(current) == len(prompt_parts):
+        return prompt_parts
+    add("user", current)
+    return contents
+
+def history_text(message: Message, text_content: str) -> str:
+    """Текст реплики пользователя для истории: в группах - с именем автора."""
+    text = text_content or ""
+    if message.photo or message.sticker:
+        text = f"[фото] {text}".strip()
+    if message.chat.type != "private" and message.from_user and text:
+        text = f"{message.from_user.first_name}: {text}"
+    return text
+
+# --- ОБЩЕЕ СОСТОЯНИЕ ПРОЦЕССОВ ---
+class SqliteStateBackend:
+    """Общее состояние процессов в одном файле SQLite: ключ-значение с TTL
+    (лимиты, кэши), очередь апдейтов от приёмника к воркерам и собранные
+    за день сообщения отслеживаемых пользователей.
+    
+    Другой бэкенд (Redis и т.п.) - класс с теми же методами в STATE_BACKENDS.
+    Методы блокирующие, вызываются через asyncio.to_thread.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, worker INTEGER NOT NULL, payload TEXT NOT NULL, created_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS updates_worker ON updates (worker, id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS collected ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_name TEXT NOT NULL, payload TEXT NOT NULL)"
+            )
+    
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+    
+    def get(self, namespace: str, key: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, namespace: str, key: str, value, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+    
+    def items(self, namespace: str) -> Dict[str, object]:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            rows = conn.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+    
+    def push_update(self, worker: int, payload: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO updates (worker, payload, created_at) VALUES (?, ?, ?)",
+                (worker, payload, time.time())
+            )
+    
+    def claim_updates(self, worker: int, limit: int = UPDATE_BATCH) -> List[str]:
+        """Забирает апдейты воркера из очереди (и удаляет их) в порядке поступления."""
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                "SELECT id, payload FROM updates WHERE worker = ? ORDER BY id LIMIT ?", (worker, limit)
+            ).fetchall()
+            if rows:
+                conn.execute("DELETE FROM updates WHERE worker = ? AND id <= ?", (worker, rows[-1][0]))
+        return [payload for _, payload in rows]
+    
+    def append_collected(self, user_name: str, payload: Dict):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO collected (user_name, payload) VALUES (?, ?)",
+                (user_name, json.dumps(payload, ensure_ascii=False))
+            )
+    
+    def collected(self, user_name: str) -> List[Dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT payload FROM collected WHERE user_name = ? ORDER BY id", (user_name,)
+            ).fetchall()
+        return [json.loads(payload) for payload, in rows]
+    
+    def clear_collected(self, user_name: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM collected WHERE user_name = ?", (user_name,))
+
+STATE_BACKENDS = {"sqlite": SqliteStateBackend}
+
+def make_state_backend():
+    """Создаёт общее хранилище по STATE_BACKEND (None, если STATE_DB не задан)."""
+    if not STATE_DB:
+        return None
+    return STATE_BACKENDS[STATE_BACKEND](STATE_DB)
+
+async def state_get(namespace: str, key: str):
+    """Значение из общего хранилища (None, если его нет или хранилище недоступно)."""
+    if STATE is None:
+        return None
+    try:
+        return await asyncio.to_thread(STATE.get, namespace, key)
+    except Exception as e:
+        log.warning(f"⚠️ Общее состояние не прочитано: {e}")
+        return None
+
+async def state_items(namespace: str) -> Dict[str, object]:
+    """Все живые значения пространства имён из общего хранилища."""
+    if STATE is None:
+        return {}
+    try:
+        return await asyncio.to_thread(STATE.items, namespace)
+    except Exception as e:
+        log.warning(f"⚠️ Общее состояние не прочитано: {e}")
+        return {}
+
+async def _state_set(namespace: str, key: str, value, ttl: Optional[float]):
+    try:
+        await asyncio.to_thread(STATE.set, namespace, key, value, ttl)
+    except Exception as e:
+        log.warning(f"⚠️ Общее состояние не записано: {e}")
+
+def publish_state(namespace: str, key: str, value, ttl: Optional[float] = None):
+    """Фоново записывает значение в общее хранилище, не задерживая ответ."""
+    if STATE is None:
+        return
+    task = asyncio.create_task(_state_set(namespace, key, value, ttl))
+    STATE_TASKS.add(task)
+    task.add_done_callback(STATE_TASKS.discard)
+
+def route_update(payload: Dict) -> int:
+    """Номер воркера для апдейта: все апдейты одного чата - в один воркер,
+    поэтому очередь чата, его настройки и кэш фото остаются локальными."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if payload.get(field):
+            return payload[field]["chat"]["id"] % WORKERS
+    callback = payload.get("callback_query")
+    if callback:
+        if callback.get("message"):
+            return callback["message"]["chat"]["id"] % WORKERS
+        return callback["from"]["id"] % WORKERS
+    return payload.get("update_id", 0) % WORKERS
+
+async def push_update(payload: Dict):
+    """Кладёт апдейт в очередь своего воркера."""
+    await asyncio.to_thread(
+        STATE.push_update, route_update(payload), json.dumps(payload, ensure_ascii=False)
+    )
+
+# --- МЕТРИКИ (/metrics в формате Prometheus) ---
+METRIC_DEFINITIONS = {
+    "bot_gemini_latency_seconds": ("histogram", "Время ответа Gemini по модели и ключу", METRIC_LATENCY_BUCKETS),
+    "bot_tts_latency_seconds": ("histogram", "Время синтеза речи edge-tts", METRIC_LATENCY_BUCKETS),
+    "bot_tts_bytes": ("histogram", "Размер синтезированного аудио", METRIC_BYTES_BUCKETS),
+    "bot_telegram_upload_seconds": ("histogram", "Время отправки голоса в Telegram", METRIC_LATENCY_BUCKETS),
+    "bot_queue_wait_seconds": ("histogram", "Ожидание сообщения в очереди чата", METRIC_LATENCY_BUCKETS),
+    "bot_gemini_quota_errors_total": ("counter", "Ответы Gemini 429/404 (лимит или нет модели)", None),
+    "bot_failovers_total": ("counter", "Переключения на другую пару ключ/модель", None),
+    "bot_cache_hits_total": ("counter", "Попадания в кэши", None),
+    "bot_cache_misses_total": ("counter", "Промахи кэшей", None),
+    "bot_dropped_messages_total": ("counter", "Выброшенные сообщения", None),
+    "bot_hedges_total": ("counter", "Дубли запросов к Gemini по исходу (hedge/primary/failed)", None),
+    "bot_hedges_skipped_total": ("counter", "Дубли, которые не отправили (budget/no_route)", None),
+    "bot_malformed_responses_total": ("counter", "Ответы RU/AZ с браком (not_json/partial/unparsed)", None),
+}
+
+def _label_pair(name: str, value: object) -> str:
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+    return f'{name}="{escaped}"'
+
+def _metric_labels(labels: Dict[str, object]) -> str:
+    return ",".join(_label_pair(name, value) for name, value in sorted(labels.items()))
+
+def inc_metric(name: str, amount: float = 1, **labels):
+    """Увеличивает счётчик."""
+    series = METRICS.setdefault(name, {})
+    key = _metric_labels(labels)
+    series[key] = series.get(key, 0) + amount
+
+def observe_metric(name: str, value: float, **labels):
+    """Добавляет наблюдение в гистограмму."""
+    buckets = METRIC_DEFINITIONS[name][2]
+    series = METRICS.setdefault(name, {})
+    key = _metric_labels(labels)
+    state = series.get(key)
+    if state is None:
+        state = series[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+    index = bisect.bisect_left(buckets, value)
+    if index < len(buckets):
+        state["buckets"][index] += 1
+    state["sum"] += value
+    state["count"] += 1
+
+def _labels_block(*parts: str) -> str:
+    joined = ",".join(part for part in parts if part)
+    return f"{{{joined}}}" if joined else ""
+
+def render_metrics(sources: List[Tuple[str, Dict]]) -> str:
+    """Текстовый формат Prometheus. sources - [(доп. метки, метрики процесса)]."""
+    lines = []
+    for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for extra, metrics in sources:
+            for labels, value in metrics.get(name, {}).items():
+                if kind == "counter":
+                    lines.append(f"{name}{_labels_block(extra, labels)} {value}")
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets, value["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels_block(extra, labels, _label_pair('le', le))} {cumulative}")
+                inf_label = _label_pair("le", "+Inf")
+                lines.append(f"{name}_bucket{_labels_block(extra, labels, inf_label)} {value['count']}")
+                lines.append(f"{name}_sum{_labels_block(extra, labels)} {value['sum']}")
+                lines.append(f"{name}_count{_labels_block(extra, labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+# --- ТРАССИРОВКА ЭТАПОВ (фото -> LLM -> парсинг -> TTS -> отправка) ---
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Спан этапа внутри текущей трассы; без трассы ничего не делает."""
+    trace = TRACE_CURRENT.get()
+    if trace is None:
+        yield None
+        return
+    
+    span = {
+        "span_id": os.urandom(8).hex(),
+        "parent_id": TRACE_PARENT.get(),
+        "name": name,
+        "start": time.time(),
+        "attributes": attributes,
+    }
+    token = TRACE_PARENT.set(span["span_id"])
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        span["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        TRACE_PARENT.reset(token)
+        trace["spans"].append(span)
+
+@contextmanager
+def trace_request(name: str, **attributes):
+    """Открывает трассу сообщения (если TRACING) с корневым спаном name."""
+    if not TRACING:
+        yield None
+        return
+    
+    trace = {"trace_id": os.urandom(16).hex(), "request_id": REQUEST_ID.get(), "spans": []}
+    token = TRACE_CURRENT.set(trace)
+    try:
+        with trace_span(name, **attributes) as root:
+            yield trace
+    finally:
+        TRACE_CURRENT.reset(token)
+        trace["name"] = name
+        trace["start"] = root["start"]
+        trace["duration_ms"] = root["duration_ms"]
+        finish_trace(trace)
+
+def finish_trace(trace: Dict):
+    """Запоминает трассу среди самых медленных и фоново экспортирует."""
+    entry = (trace["duration_ms"], next(TRACE_SEQUENCE), trace)
+    if len(TRACE_SLOWEST_HEAP) < TRACE_SLOWEST:
+        heapq.heappush(TRACE_SLOWEST_HEAP, entry)
+    elif entry[0] > TRACE_SLOWEST_HEAP[0][0]:
+        heapq.heapreplace(TRACE_SLOWEST_HEAP, entry)
+    
+    for export in (TRACE_FILE and export_trace_file, TRACE_OTLP_URL and export_trace_otlp):
+        if export:
+            task = asyncio.create_task(export(trace))
+            TRACE_TASKS.add(task)
+            task.add_done_callback(TRACE_TASKS.discard)
+
+def slowest_traces(limit: int = TRACE_SLOWEST) -> List[Dict]:
+    return [trace for _, _, trace in sorted(TRACE_SLOWEST_HEAP, reverse=True)[:limit]]
+
+def _append_trace_line(line: str):
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+async def export_trace_file(trace: Dict):
+    try:
+        await asyncio.to_thread(_append_trace_line, json.dumps(trace, ensure_ascii=False))
+    except OSError as e:
+        log.warning(f"⚠️ Трасса не записана: {e}")
+
+def otlp_payload(trace: Dict) -> Dict:
+    """Трасса в формате OTLP/HTTP JSON (ExportTraceServiceRequest)."""
+    spans = []
+    for span in trace["spans"]:
+        start_ns = int(span["start"] * 1e9)
+        attributes = [{"key": key, "value": {"stringValue": str(value)}} for key, value in span["attributes"].items()]
+        spans.append({
+            "traceId": trace["trace_id"],
+            "spanId": span["span_id"],
+            "parentSpanId": span["parent_id"] or "",
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(span["duration_ms"] * 1e6)),
+            "attributes": attributes,
+            "status": {"code": 2, "message": span["error"]} if span.get("error") else {},
+        })
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "antibotik"}}]},
+        "scopeSpans": [{"scope": {"name": "antibotik"}, "spans": spans}],
+    }]}
+
+async def export_trace_otlp(trace: Dict):
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(TRACE_OTLP_URL, json=otlp_payload(trace),
+                                    timeout=aiohttp.ClientTimeout(total=5)) as resp:
+                if resp.status >= 300:
+                    log.warning(f"⚠️ Коллектор трасс ответил {resp.status}")
+    except Exception as e:
+        log.warning(f"⚠️ Трасса не отправлена: {e}")
+
 # --- ЛОГИКА АВТО-ПОДБОРА МОДЕЛИ ---
-def get_dynamic_model_list():
-    """Получает список доступных моделей Gemini."""
+HARDCODED_MODELS = ["gemini-exp-1206", "gemini-1.5-flash", "gemini-1.5-flash-8b", "gemini-2.0-flash-exp", "gemini-3-flash-preview"]
+
+def get_dynamic_model_list(key_index: int) -> Tuple[List[str], bool]:
+    """Получает список доступных моделей Gemini (блокирующий вызов, запускать в потоке)."""
     available_models = []
+    listed = True
     try:
-        for m in genai.list_models():
+        model_client = KEY_POOL[key_index]["clients"].get_default_client("model")
+        for m in genai.list_models(client=model_client):
             if 'generateContent' in m.supported_generation_methods:
                 name = m.name.replace("models/", "")
                 if "gemini" in name:
                     available_models.append(name)
     except Exception as e:
-        print(f"⚠️ Ошибка получения списка моделей: {e}")
+        listed = False
+        log.warning(f"⚠️ Ошибка получения списка моделей: {e}")
     
-    hardcoded = ["gemini-exp-1206", "gemini-1.5-flash", "gemini-1.5-flash-8b", "gemini-2.0-flash-exp", "gemini-3-flash-preview"]
-    for h in hardcoded:
+    for h in HARDCODED_MODELS:
         if h not in available_models:
             available_models.append(h)
     
-    return list(set(available_models))
+    return list(set(available_models)), listed
+
+async def get_cached_model_list(key_index: int) -> List[str]:
+    """Возвращает список моделей для ключа из кэша, обновляя его вне event loop."""
+    now = time.monotonic()
+    cached = MODEL_LIST_CACHE.get(key_index)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    try:
+        models, listed = await asyncio.wait_for(
+            asyncio.to_thread(get_dynamic_model_list, key_index), timeout=MODEL_PROBE_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        # Сеть висит - не держим probe_lock и старт воркера, берём известные модели
+        log.warning(f"⚠️ Список моделей API #{key_index + 1} не получен за {MODEL_PROBE_TIMEOUT:.0f} сек")
+        models, listed = list(HARDCODED_MODELS), False
+    ttl = MODEL_LIST_TTL if listed else MODEL_LIST_RETRY
+    MODEL_LIST_CACHE[key_index] = (now + ttl, models)
+    return models
+
+def model_priority_score(name: str) -> int:
+    """Эвристика по имени модели: порядок проверки моделей ключа и априорная оценка для роутера.
+    
+    В роутер попадают только ответившие на проверку, а проверяются первые
+    MODEL_PROBE_CANDIDATES по этой оценке - так что она решает, какие модели вообще будут в работе.
+    """
+    s = 0
+    if "exp" in name: s += 500
+    if "3-" in name or "2.5-" in name: s += 400
+    if "flash" in name: s += 300
+    if "1.5" in name: s += 50
+    if "8b" in name: s += 250
+    if "lite" in name: s += 100
+    if "pro" in name: s -= 50
+    if "preview" in name: s -= 20
+    return s
 
 def sort_models_priority(models):
     """Сортирует модели по приоритету."""
-    def score(name):
-        s = 0
-        if "exp" in name: s += 500
-        if "3-" in name or "2.5-" in name: s += 400
-        if "flash" in name: s += 300
-        if "1.5" in name: s += 50
-        if "8b" in name: s += 250
-        if "lite" in name: s += 100
-        if "pro" in name: s -= 50
-        if "preview" in name: s -= 20
-        return s
-    
-    return sorted(models, key=score, reverse=True)
-
-async def switch_api_key(silent: bool = True) -> bool:
-    """Переключается на следующий доступный API ключ."""
-    global CURRENT_API_KEY_INDEX, ACTIVE_MODEL, ACTIVE_MODEL_NAME
-    
-    old_index = CURRENT_API_KEY_INDEX
-    
-    for i in range(len(GOOGLE_KEYS)):
-        next_index = (CURRENT_API_KEY_INDEX + 1) % len(GOOGLE_KEYS)
-        if next_index == old_index:
-            return False
+    return sorted(models, key=model_priority_score, reverse=True)
+
+# --- УЧЁТ КВОТ (КЛЮЧ × МОДЕЛЬ) ---
+RETRY_HINT_PATTERNS = [
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)', re.IGNORECASE),
+    re.compile(r'retry in\s*([\d.]+)\s*s', re.IGNORECASE),
+    re.compile(r'retry[- ]after:?\s*([\d.]+)', re.IGNORECASE),
+]
+
+def get_ledger_entry(key_index: int, model_name: str) -> Dict:
+    """Возвращает (создаёт) запись учёта для пары ключ/модель."""
+    entry = QUOTA_LEDGER.get((key_index, model_name))
+    if entry is None:
+        entry = {
+            "limited_until": 0.0,
+            "strikes": 0,
+            "minute": deque(),  # (время, токены) за последние 60 сек
+            "day": "",
+            "day_requests": 0,
+            "day_tokens": 0,
+            "remote": {"minute_requests": 0, "minute_tokens": 0, "day_requests": 0},  # другие процессы
+        }
+        QUOTA_LEDGER[(key_index, model_name)] = entry
+    return entry
+
+def parse_retry_after(error_text: str) -> Optional[float]:
+    """Достаёт из текста ошибки рекомендуемую паузу в секундах."""
+    for pattern in RETRY_HINT_PATTERNS:
+        match = pattern.search(error_text)
+        if match:
+            try:
+                return float(match.group(1))
+            except ValueError:
+                pass
+    return None
+
+def seconds_until_quota_reset() -> float:
+    """Секунды до сброса дневной квоты (полночь по тихоокеанскому времени)."""
+    now = datetime.now(QUOTA_RESET_TZ)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return 86400 - (now - midnight).total_seconds()
+
+def mark_model_limited(key_index: int, model_name: str, error_text: str):
+    """Отправляет пару ключ/модель в кулдаун. Повторные лимиты удлиняют паузу."""
+    entry = get_ledger_entry(key_index, model_name)
+    
+    if "404" in error_text:
+        cooldown = QUOTA_NOT_FOUND_COOLDOWN
+    elif "PerDay" in error_text or "per day" in error_text.lower():
+        cooldown = seconds_until_quota_reset()
+    else:
+        cooldown = parse_retry_after(error_text)
+        if cooldown is None:
+            cooldown = min(QUOTA_COOLDOWN * 2 ** entry["strikes"], QUOTA_MAX_COOLDOWN)
+    
+    entry["strikes"] += 1
+    entry["limited_until"] = max(entry["limited_until"], time.time() + cooldown)
+    publish_state("quota", f"{key_index}:{model_name}", entry["limited_until"], ttl=cooldown)
+    invalidate_cached_models(key_index, model_name)
+    log.warning(f"⏳ Лимит {model_name} на API #{key_index + 1}: пауза {int(cooldown)} сек")
+
+def mark_probe_failed(key_index: int, model_name: str, reason: str):
+    """Модель не ответила на проверку (таймаут, 400/403, 5xx): кулдаун с нарастающей паузой,
+    чтобы следующий переподбор проверял другие модели, а не эти же."""
+    entry = get_ledger_entry(key_index, model_name)
+    cooldown = min(QUOTA_COOLDOWN * 2 ** entry["strikes"], QUOTA_MAX_COOLDOWN)
+    entry["strikes"] += 1
+    entry["limited_until"] = max(entry["limited_until"], time.time() + cooldown)
+    publish_state("quota", f"{key_index}:{model_name}", entry["limited_until"], ttl=cooldown)
+    invalidate_cached_models(key_index, model_name)
+    log.warning(f"🔇 {model_name} на API #{key_index + 1} не прошла проверку ({reason[:100]}): пауза {int(cooldown)} сек")
+
+def is_model_limited(key_index: int, model_name: str) -> bool:
+    """Пара ключ/модель в кулдауне?"""
+    entry = QUOTA_LEDGER.get((key_index, model_name))
+    return bool(entry) and entry["limited_until"] > time.time()
+
+def _roll_usage_windows(entry: Dict, now: float):
+    """Сдвигает минутное окно и дневные счётчики."""
+    while entry["minute"] and entry["minute"][0][0] <= now - 60:
+        entry["minute"].popleft()
+    
+    today = datetime.now(QUOTA_RESET_TZ).date().isoformat()
+    if entry["day"] != today:
+        entry["day"] = today
+        entry["day_requests"] = 0
+        entry["day_tokens"] = 0
+
+def record_model_usage(key_index: int, model_name: str, tokens: int = 0):
+    """Учитывает успешный запрос и потраченные токены."""
+    now = time.time()
+    entry = get_ledger_entry(key_index, model_name)
+    _roll_usage_windows(entry, now)
+    entry["minute"].append((now, tokens))
+    entry["day_requests"] += 1
+    entry["day_tokens"] += tokens
+    entry["strikes"] = 0
+
+def is_near_quota(key_index: int, model_name: str) -> bool:
+    """Пара ключ/модель близка к минутной или дневной квоте?"""
+    entry = QUOTA_LEDGER.get((key_index, model_name))
+    if not entry:
+        return False
+    
+    _roll_usage_windows(entry, time.time())
+    remote = entry["remote"]
+    minute_requests = len(entry["minute"]) + remote["minute_requests"]
+    minute_tokens = sum(tokens for _, tokens in entry["minute"]) + remote["minute_tokens"]
+    
+    checks = [
+        (QUOTA_RPM, minute_requests),
+        (QUOTA_TPM, minute_tokens),
+        (QUOTA_RPD, entry["day_requests"] + remote["day_requests"]),
+    ]
+    return any(limit and used >= limit * QUOTA_SOFT_RATIO for limit, used in checks)
+
+def is_model_available(key_index: int, model_name: str) -> bool:
+    """Пару можно использовать: нет кулдауна и квота не на исходе."""
+    return not is_model_limited(key_index, model_name) and not is_near_quota(key_index, model_name)
+
+def usage_snapshot(entry: Dict) -> Dict:
+    """Расход пары этим процессом - для других процессов."""
+    _roll_usage_windows(entry, time.time())
+    return {
+        "at": time.time(),
+        "day": entry["day"],
+        "minute_requests": len(entry["minute"]),
+        "minute_tokens": sum(tokens for _, tokens in entry["minute"]),
+        "day_requests": entry["day_requests"],
+    }
+
+async def sync_quota_state():
+    """Обмен лимитами с другими процессами: публикуем свой расход,
+    подтягиваем чужие кулдауны и расход на те же ключи."""
+    for (key_index, model_name), entry in list(QUOTA_LEDGER.items()):
+        if entry["day_requests"]:
+            publish_state("usage", f"{WORKER_INDEX}:{key_index}:{model_name}", usage_snapshot(entry),
+                          ttl=seconds_until_quota_reset())
+    
+    for pair, limited_until in (await state_items("quota")).items():
+        key_index, model_name = pair.split(":", 1)
+        entry = get_ledger_entry(int(key_index), model_name)
+        if limited_until > entry["limited_until"]:
+            entry["limited_until"] = limited_until
+            invalidate_cached_models(int(key_index), model_name)
+    
+    now = time.time()
+    today = datetime.now(QUOTA_RESET_TZ).date().isoformat()
+    remote = {}
+    for name, snapshot in (await state_items("usage")).items():
+        worker, key_index, model_name = name.split(":", 2)
+        if int(worker) == WORKER_INDEX or snapshot["day"] != today:
+            continue
+        totals = remote.setdefault((int(key_index), model_name),
+                                   {"minute_requests": 0, "minute_tokens": 0, "day_requests": 0})
+        if now - snapshot["at"] < 60:
+            totals["minute_requests"] += snapshot["minute_requests"]
+            totals["minute_tokens"] += snapshot["minute_tokens"]
+        totals["day_requests"] += snapshot["day_requests"]
+    
+    for pair, entry in QUOTA_LEDGER.items():
+        entry["remote"] = remote.pop(pair, {"minute_requests": 0, "minute_tokens": 0, "day_requests": 0})
+    for (key_index, model_name), totals in remote.items():
+        get_ledger_entry(key_index, model_name)["remote"] = totals
+
+async def state_sync_loop():
+    """Фоновая синхронизация лимитов между процессами."""
+    if STATE is None:
+        return
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+        try:
+            await sync_quota_state()
+            if BOT_ROLE == "worker":
+                # HTTP у воркера нет: /metrics приёмника читает снимок из общего хранилища
+                publish_state("metrics", str(WORKER_INDEX), json.loads(json.dumps(METRICS)),
+                              ttl=STATE_SYNC_INTERVAL * 5)
+                if TRACING:
+                    publish_state("traces", str(WORKER_INDEX), slowest_traces(), ttl=STATE_SYNC_INTERVAL * 5)
+        except Exception as e:
+            log.warning(f"⚠️ Синхронизация лимитов: {e}")
+
+def get_usage_tokens(response) -> int:
+    """Количество токенов из usage_metadata ответа (0, если нет)."""
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", 0) or 0
+
+def get_response_text(response) -> Optional[str]:
+    """Текст ответа; None, если в нём нет частей (блокировка, лимит токенов)."""
+    try:
+        return response.text
+    except ValueError:
+        return None
+
+def finish_reason(response) -> str:
+    """Причина остановки генерации первого кандидата ("STOP", "MAX_TOKENS", ...)."""
+    candidates = getattr(response, "candidates", None)
+    if not candidates:
+        return ""
+    reason = getattr(candidates[0], "finish_reason", "")
+    return getattr(reason, "name", str(reason))
+
+def is_quota_error(error_text: str) -> bool:
+    """Ошибка означает лимит/отсутствие модели на ключе?"""
+    return "429" in error_text or "quota" in error_text or "404" in error_text
+
+# --- РОУТЕР: ОЖИДАЕМОЕ ВРЕМЯ ОТВЕТА ПАРЫ КЛЮЧ/МОДЕЛЬ ---
+def get_route_stats(key_index: int, model_name: str) -> Dict:
+    stats = ROUTE_STATS.get((key_index, model_name))
+    if stats is None:
+        stats = ROUTE_STATS[(key_index, model_name)] = {
+            "calls": deque(maxlen=ROUTER_WINDOW),  # (задержка, успех)
+            "quality": deque(maxlen=ROUTER_WINDOW),  # ответ удалось разобрать
+        }
+    return stats
+
+def record_route_outcome(key_index: int, model_name: str, latency: float, ok: bool):
+    """Запоминает задержку и исход запроса (лимиты сюда не попадают - для них кулдаун)."""
+    get_route_stats(key_index, model_name)["calls"].append((latency, ok))
+
+def record_route_quality(key_index: int, model_name: str, ok: bool):
+    """Запоминает, получился ли из ответа пригодный результат (RU/AZ разобраны и т.п.)."""
+    get_route_stats(key_index, model_name)["quality"].append(ok)
+
+def expected_answer_time(key_index: int, model_name: str) -> float:
+    """Ожидаемое время до пригодного ответа: средняя задержка / вероятность успеха.
+    
+    Пока наблюдений мало, тянется к априорной оценке по имени модели:
+    каждые 1000 очков эвристики - вдвое меньше ROUTER_PRIOR_LATENCY.
+    """
+    prior_latency = ROUTER_PRIOR_LATENCY * 2 ** (-model_priority_score(model_name) / 1000)
+    stats = ROUTE_STATS.get((key_index, model_name))
+    calls = stats["calls"] if stats else ()
+    quality = stats["quality"] if stats else ()
+    
+    latencies = [latency for latency, ok in calls if ok]
+    latency = (sum(latencies) + ROUTER_PRIOR_WEIGHT * prior_latency) / (len(latencies) + ROUTER_PRIOR_WEIGHT)
+    success = (sum(ok for _, ok in calls) + ROUTER_PRIOR_WEIGHT * 0.9) / (len(calls) + ROUTER_PRIOR_WEIGHT)
+    usable = (sum(quality) + ROUTER_PRIOR_WEIGHT * 0.9) / (len(quality) + ROUTER_PRIOR_WEIGHT)
+    return latency / max(success * usable, 0.05)
+
+def choose_route(candidates: List[Tuple[int, str]]) -> Tuple[int, str]:
+    """Лучшая пара по ожидаемому времени с учётом загрузки ключа;
+    с вероятностью ROUTER_EXPLORE - случайная другая, чтобы статистика не застаивалась."""
+    def cost(route):
+        key_index, model_name = route
+        return expected_answer_time(key_index, model_name) * (1 + ROUTER_LOAD_PENALTY * KEY_POOL[key_index]["in_flight"])
+    
+    best = min(candidates, key=cost)
+    if len(candidates) > 1 and random.random() < ROUTER_EXPLORE:
+        return random.choice([route for route in candidates if route != best])
+    return best
+
+# --- ПУЛ API КЛЮЧЕЙ ---
+def init_key_pool():
+    """Создаёт по отдельному клиенту genai на каждый ключ (без глобального genai.configure)."""
+    KEY_POOL.clear()
+    for i, key in enumerate(GOOGLE_KEYS):
+        clients = genai_client._ClientManager()
+        clients.configure(api_key=key)
+        KEY_POOL.append({
+            "index": i,
+            "clients": clients,
+            "model": None,  # лучшая модель ключа по роутеру (для статуса)
+            "models": [],  # модели, ответившие на проверку
+            "in_flight": 0,
+            "probe_lock": asyncio.Lock(),
+            "refresh_task": None,
+            "next_refresh_at": 0.0,  # monotonic: раньше ключ не переподбирается
+            "refresh_failures": 0,
+        })
+        log.info(f"✅ API #{i + 1}")
+
+def bind_model_to_key(model: genai.GenerativeModel, key_index: int) -> genai.GenerativeModel:
+    """Привязывает модель к клиенту конкретного ключа."""
+    # GenerativeModel берёт глобальный клиент лениво, если _async_client не задан
+    model._async_client = KEY_POOL[key_index]["clients"].get_default_client("generative_async")
+    return model
+
+def get_cached_model(model_name: str, system_prompt: Optional[str], key_index: int,
+                     profile: str = "archiver_az") -> genai.GenerativeModel:
+    """Возвращает готовую модель из LRU, создавая её только при промахе."""
+    cache_key = (model_name, system_prompt, profile, key_index)
+    model = MODEL_CACHE.get(cache_key)
+    if model is not None:
+        MODEL_CACHE.move_to_end(cache_key)
+        return model
+    
+    model = bind_model_to_key(genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=GENERATION_PROFILES[profile],
+        system_instruction=system_prompt
+    ), key_index)
+    MODEL_CACHE[cache_key] = model
+    while len(MODEL_CACHE) > MODEL_CACHE_SIZE:
+        MODEL_CACHE.popitem(last=False)
+    return model
+
+def invalidate_cached_models(key_index: int, model_name: Optional[str] = None):
+    """Выкидывает из LRU модели ключа (или только одну модель на ключе)."""
+    for cache_key in list(MODEL_CACHE):
+        cached_model, _, _, cached_key_index = cache_key
+        if cached_key_index == key_index and model_name in (None, cached_model):
+            del MODEL_CACHE[cache_key]
+
+def available_models(entry: Dict) -> List[str]:
+    """Рабочие модели ключа вне кулдауна и не у квоты."""
+    return [name for name in entry["models"] if is_model_available(entry["index"], name)]
+
+def is_key_healthy(entry: Dict) -> bool:
+    """У ключа есть хотя бы одна рабочая модель не в кулдауне."""
+    return bool(available_models(entry))
+
+def has_working_model() -> bool:
+    """Есть ли хоть один ключ с рабочей моделью."""
+    return any(is_key_healthy(entry) for entry in KEY_POOL)
+
+def schedule_key_refresh(entry: Dict):
+    """Фоном переподбирает модель для нездорового ключа (одна задача на ключ, не раньше next_refresh_at)."""
+    if time.monotonic() < entry["next_refresh_at"]:
+        return
+    task = entry["refresh_task"]
+    if task is None or task.done():
+        entry["refresh_task"] = asyncio.create_task(find_best_working_model(entry["index"], silent=True))
+
+async def acquire_route(avoid: Optional[set] = None) -> Optional[Tuple[int, str]]:
+    """Выбирает пару ключ/модель роутером среди здоровых ключей.
+    
+    avoid - пары, уже давшие в этом запросе пустой ответ: берутся, только если других нет.
+    """
+    healthy = [entry for entry in KEY_POOL if is_key_healthy(entry)]
+    for entry in KEY_POOL:
+        if not is_key_healthy(entry):
+            schedule_key_refresh(entry)
+    
+    if not healthy:
+        # Здоровых нет - ждём переподбора на всех ключах сразу
+        await asyncio.gather(
+            *(find_best_working_model(entry["index"], silent=True) for entry in KEY_POOL),
+            return_exceptions=True
+        )
+        healthy = [entry for entry in KEY_POOL if is_key_healthy(entry)]
+        if not healthy:
+            return None
+    
+    candidates = [(entry["index"], name) for entry in healthy for name in available_models(entry)]
+    key_index, model_name = choose_route([route for route in candidates if route not in (avoid or ())] or candidates)
+    KEY_POOL[key_index]["model"] = model_name
+    return key_index, model_name
+
+async def generate_on_key(key_index: int, model_name: str, system_prompt: str, contents,
+                          profile: str = "archiver_az", on_chunk=None):
+    """Запрос к модели на ключе с учётом загрузки и расхода квоты.
+    
+    Если передан on_chunk, ответ читается потоком: колбэк получает накопленный
+    текст после каждого фрагмента. Ответ помечается парой (response.route) -
+    по ней потом учитывается качество.
+    """
+    entry = KEY_POOL[key_index]
+    
+    async with LLM_SEMAPHORE:
+        entry["in_flight"] += 1
+        started = time.monotonic()
+        try:
+            model = get_cached_model(model_name, system_prompt, key_index, profile)
+            with trace_span("generate", model=model_name, key=key_index + 1, profile=profile,
+                            stream=on_chunk is not None):
+                if on_chunk is None:
+                    response = await model.generate_content_async(contents)
+                else:
+                    response = await model.generate_content_async(contents, stream=True)
+                    streamed_text = ""
+                    async for chunk in response:
+                        try:
+                            streamed_text += chunk.text
+                        except ValueError:
+                            continue  # фрагмент без текста (служебный/фильтр)
+                        await on_chunk(streamed_text)
+        except asyncio.CancelledError as e:
+            # Отмена по дедлайну - пара зависла, это худший исход для роутера.
+            # Проигравший гонку дубль не виноват: его не учитываем
+            if e.args != (HEDGE_CANCEL_MSG,):
+                record_route_outcome(key_index, model_name, time.monotonic() - started, ok=False)
+            raise
+        except Exception as e:
+            if not is_quota_error(str(e)):
+                record_route_outcome(key_index, model_name, time.monotonic() - started, ok=False)
+            raise
+        finally:
+            entry["in_flight"] -= 1
+    
+    latency = time.monotonic() - started
+    observe_metric("bot_gemini_latency_seconds", latency, model=model_name, key=key_index + 1)
+    record_route_outcome(key_index, model_name, latency, ok=True)
+    record_model_usage(key_index, model_name, get_usage_tokens(response))
+    response.route = (key_index, model_name)
+    return response
+
+def note_quota_error(key_index: int, model_name: str, error_str: str):
+    """Ставит пару в кулдаун по ошибке лимита и учитывает её в метриках."""
+    inc_metric("bot_gemini_quota_errors_total", model=model_name, key=key_index + 1,
+               code="404" if "404" in error_str else "429")
+    mark_model_limited(key_index, model_name, error_str)
+
+def hedge_delay(key_index: int, model_name: str) -> Optional[float]:
+    """Через сколько секунд без ответа отправлять дубль: HEDGE_PERCENTILE задержки пары
+    (или всех пар, если у этой мало наблюдений). None - статистики ещё нет."""
+    latencies = [latency for latency, ok in get_route_stats(key_index, model_name)["calls"] if ok]
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        latencies = [latency for stats in ROUTE_STATS.values() for latency, ok in stats["calls"] if ok]
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    latencies.sort()
+    index = min(len(latencies) - 1, int(HEDGE_PERCENTILE * len(latencies)))
+    return max(HEDGE_MIN_DELAY, latencies[index])
+
+def hedge_budget_left() -> bool:
+    """Дублей среди последних запросов меньше HEDGE_BUDGET (с учётом нового)."""
+    return sum(HEDGE_HISTORY) + 1 <= HEDGE_BUDGET * len(HEDGE_HISTORY)
+
+def choose_hedge_route(primary: Tuple[int, str]) -> Optional[Tuple[int, str]]:
+    """Пара для дубля: здоровая, не основная, по возможности на другом ключе."""
+    candidates = [(entry["index"], name) for entry in KEY_POOL for name in available_models(entry)
+                  if (entry["index"], name) != primary]
+    other_keys = [route for route in candidates if route[0] != primary[0]]
+    if not candidates:
+        return None
+    return choose_route(other_keys or candidates)
+
+async def generate_hedged(key_index: int, model_name: str, system_prompt: str, contents,
+                          profile: str = "archiver_az", on_chunk=None):
+    """generate_on_key с дублем: если основной запрос молчит дольше hedge_delay,
+    тот же запрос уходит на другую пару, побеждает первый ответ, второй отменяется.
+    
+    Упавшая сторона не отменяет вторую: ждём её ответа. Если упали обе, ошибка
+    основного пробрасывается как есть (её разбирает failover), ошибки дубля
+    гасятся здесь. Потоковые запросы не дублируются - два потока
+    писали бы в один ответ.
+    """
+    delay = hedge_delay(key_index, model_name) if HEDGE_REQUESTS and on_chunk is None else None
+    if delay is None:
+        HEDGE_HISTORY.append(False)
+        return await generate_on_key(key_index, model_name, system_prompt, contents, profile, on_chunk=on_chunk)
+    
+    primary = asyncio.create_task(generate_on_key(key_index, model_name, system_prompt, contents, profile))
+    hedge = None
+    hedge_route = None
+    decided = False  # гонка решена: оставшийся запрос - проигравший, а не жертва дедлайна
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            HEDGE_HISTORY.append(False)
+            return primary.result()
+        
+        if not hedge_budget_left():
+            inc_metric("bot_hedges_skipped_total", reason="budget")
+        else:
+            hedge_route = choose_hedge_route((key_index, model_name))
+            if hedge_route is None:
+                inc_metric("bot_hedges_skipped_total", reason="no_route")
+        HEDGE_HISTORY.append(hedge_route is not None)
+        if hedge_route is None:
+            return await primary
+        
+        log.debug(f"🪞 Нет ответа {delay:.1f} сек, дубль в {hedge_route[1]} (API #{hedge_route[0] + 1})",
+                  extra={"fields": {"model": hedge_route[1], "key": hedge_route[0] + 1, "delay": round(delay, 3)}})
+        hedge = asyncio.create_task(generate_on_key(*hedge_route, system_prompt, contents, profile))
+        
+        # Побеждает первый успешный ответ; упавшая сторона не отменяет вторую
+        pending = {primary, hedge}
+        primary_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    decided = True
+                    if primary_error is not None and is_quota_error(str(primary_error)):
+                        note_quota_error(key_index, model_name, str(primary_error))
+                    inc_metric("bot_hedges_total", result="hedge" if task is hedge else "primary")
+                    return task.result()
+            for task in done:
+                if task is primary:
+                    primary_error = task.exception()
+                    continue
+                error_str = str(task.exception())
+                if is_quota_error(error_str):
+                    note_quota_error(*hedge_route, error_str)
+                inc_metric("bot_hedges_total", result="failed")
+        
+        # Упали оба - ошибку основного разбирает failover
+        raise primary_error
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel(HEDGE_CANCEL_MSG if decided else None)
+
+async def generate_with_failover(system_prompt: str, contents, budget: float = GEN_DEADLINE,
+                                 profile: str = "archiver_az", on_chunk=None):
+    """Генерирует ответ, переключая пары ключ/модель при лимитах.
+    
+    profile - ключ GENERATION_PROFILES (режим чата, "report" или "probe").
+    Не больше GEN_MAX_ATTEMPTS попыток и budget секунд на всё, между попытками -
+    экспоненциальная пауза со случайным разбросом. Возвращает ответ или None, если
+    рабочих пар не осталось или попытки кончились; по истечении бюджета бросает
+    asyncio.TimeoutError.
+    Прочие ошибки API пробрасываются сразу.
+    """
+    deadline = time.monotonic() + budget
+    empty_response = None  # пустой ответ с MAX_TOKENS - отдаём, если лучше ничего не будет
+    empty_routes = set()
+    
+    for attempt in range(GEN_MAX_ATTEMPTS):
+        if attempt:
+            backoff = random.uniform(0, min(GEN_BACKOFF_MAX, GEN_BACKOFF_BASE * 2 ** (attempt - 1)))
+            if time.monotonic() + backoff >= deadline:
+                break
+            await asyncio.sleep(backoff)
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        
+        # Пара выбирается на каждую попытку: пары у квоты и в кулдауне обходятся
+        route = await asyncio.wait_for(acquire_route(empty_routes), timeout=remaining)
+        if route is None:
+            return None
+        
+        key_index, model_name = route
+        log.debug(f"🚀 Запрос в {model_name} (API #{key_index + 1}), попытка {attempt + 1}",
+                  extra={"fields": {"model": model_name, "key": key_index + 1, "attempt": attempt + 1}})
         
-        CURRENT_API_KEY_INDEX = next_index
         try:
-            genai.configure(api_key=GOOGLE_KEYS[CURRENT_API_KEY_INDEX])
-            if await find_best_working_model(silent=silent):
-                return True
+            response = await asyncio.wait_for(
+                generate_hedged(key_index, model_name, system_prompt, contents, profile, on_chunk=on_chunk),
+                timeout=deadline - time.monotonic()
+            )
+            if get_response_text(response) is None and finish_reason(response) == "MAX_TOKENS":
+                # Лимит токенов ушёл на рассуждения: ответа нет, пара для профиля непригодна
+                record_route_quality(*response.route, ok=False)
+                inc_metric("bot_malformed_responses_total", reason="max_tokens")
+                log.warning(f"⚠️ Пустой ответ {response.route[1]}: лимит токенов, переспрашиваю")
+                empty_response = response
+                empty_routes.add(response.route)
+                continue
+            return response
+        except asyncio.TimeoutError:
+            raise
         except Exception as e:
-            pass
+            error_str = str(e)
+            if not is_quota_error(error_str):
+                raise
+            note_quota_error(key_index, model_name, error_str)
+            inc_metric("bot_failovers_total")
+            log.warning(f"⚠️ Лимит, переключаюсь")
+    else:
+        return empty_response  # все попытки ушли на лимиты (или пустые ответы)
     
-    return False
+    raise asyncio.TimeoutError(f"Нет ответа за {budget:.0f} сек")
 
-async def find_best_working_model(silent: bool = False) -> bool:
-    """Находит рабочую модель на текущем API ключе."""
-    global ACTIVE_MODEL, ACTIVE_MODEL_NAME, MODEL_LIMITS
-    
-    candidates = sort_models_priority(get_dynamic_model_list())
-    
-    if not silent:
-        print(f"📋 Проверка моделей на API #{CURRENT_API_KEY_INDEX + 1}")
-    
-    for model_name in candidates:
-        if MODEL_LIMITS.get(model_name, {}).get(CURRENT_API_KEY_INDEX, False):
-            continue
-        
+async def probe_model(model_name: str, key_index: int, semaphore: asyncio.Semaphore):
+    """Пингует модель с таймаутом. Возвращает готовую модель или None."""
+    async with semaphore:
         try:
-            test_model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config,
-                system_instruction=SYSTEM_PROMPT_DEFAULT
+            # Без системного промпта и с профилем "probe": пинг не тратит токены на ответ
+            test_model = get_cached_model(model_name, None, key_index, "probe")
+            response = await asyncio.wait_for(
+                test_model.generate_content_async("ping"),
+                timeout=MODEL_PROBE_TIMEOUT
             )
-            response = await test_model.generate_content_async("ping")
-            
-            if response and response.text:
-                if not silent:
-                    print(f"✅ Подключено: {model_name}")
-                ACTIVE_MODEL = test_model
-                ACTIVE_MODEL_NAME = model_name
-                return True
+            if response is not None:  # текст мог упереться в лимит токенов - модель всё равно жива
+                record_model_usage(key_index, model_name, get_usage_tokens(response))
+                return test_model
+        
+        except asyncio.TimeoutError:
+            mark_probe_failed(key_index, model_name, f"нет ответа за {MODEL_PROBE_TIMEOUT:.0f} сек")
         
         except Exception as e:
             err = str(e)
-            if "429" in err:
-                if model_name not in MODEL_LIMITS:
-                    MODEL_LIMITS[model_name] = {}
-                MODEL_LIMITS[model_name][CURRENT_API_KEY_INDEX] = True
+            if is_quota_error(err):
+                mark_model_limited(key_index, model_name, err)
+            else:
+                mark_probe_failed(key_index, model_name, err)
+    
+    return None
+
+async def adopt_shared_models(entry: Dict) -> bool:
+    """Берёт из общего хранилища проверку ключа другим процессом: ответившие модели
+    (кулдауны уже подтянуты sync_quota_state) или паузу до следующей проверки.
+    True, если после этого у ключа есть рабочая модель."""
+    key_index = entry["index"]
+    for model_name in await state_get("models", str(key_index)) or []:
+        if model_name not in entry["models"]:
+            entry["models"].append(model_name)
+    if is_key_healthy(entry):
+        entry["model"] = available_models(entry)[0]
+        return True
     
+    retry_at = await state_get("refresh", str(key_index))
+    if retry_at:
+        entry["next_refresh_at"] = max(entry["next_refresh_at"], time.monotonic() + retry_at - time.time())
     return False
 
+async def find_best_working_model(key_index: int, silent: bool = False) -> bool:
+    """Находит рабочую модель на API ключе.
+    
+    За один вызов пингуются только MODEL_PROBE_CANDIDATES лучших по эвристике
+    моделей вне кулдауна (не более MODEL_PROBE_CONCURRENCY сразу): каждый пинг
+    тратит дневную квоту. Ключ готов, как только ответила самая приоритетная
+    модель; остальные досчитываются фоном и тоже попадают в роутер.
+    Не ответившие уходят в кулдаун, поэтому следующий переподбор возьмёт
+    следующие модели, а сам он будет не раньше чем через KEY_REFRESH_INTERVAL
+    (пауза удваивается с каждой неудачей подряд).
+    Результат проверки другого процесса (общее хранилище) берётся без пингов.
+    """
+    entry = KEY_POOL[key_index]
+    
+    async with entry["probe_lock"]:
+        # Пока ждали блокировку, ключ мог уже переподобрать другой запрос
+        if is_key_healthy(entry):
+            return True
+        if time.monotonic() < entry["next_refresh_at"]:
+            return False
+        if await adopt_shared_models(entry):
+            return True
+        if time.monotonic() < entry["next_refresh_at"]:
+            return False
+        
+        candidates = [
+            name for name in sort_models_priority(await get_cached_model_list(key_index))
+            if is_model_available(key_index, name)
+        ]
+        
+        if not silent:
+            log.debug(f"📋 Проверка моделей на API #{key_index + 1}")
+        
+        def remember_working(task: asyncio.Task, model_name: str):
+            if not task.cancelled() and task.exception() is None and task.result():
+                if model_name not in entry["models"]:
+                    entry["models"].append(model_name)
+                    publish_state("models", str(key_index), list(entry["models"]), ttl=MODEL_LIST_TTL)
+        
+        semaphore = asyncio.Semaphore(MODEL_PROBE_CONCURRENCY)
+        batch = candidates[:MODEL_PROBE_CANDIDATES]
+        tasks = [asyncio.create_task(probe_model(name, key_index, semaphore)) for name in batch]
+        for model_name, task in zip(batch, tasks):
+            PROBE_TASKS.add(task)
+            task.add_done_callback(PROBE_TASKS.discard)
+            task.add_done_callback(lambda task, model_name=model_name: remember_working(task, model_name))
+        
+        # Ждём в порядке приоритета
+        for model_name, task in zip(batch, tasks):
+            if await asyncio.shield(task):
+                if not silent:
+                    log.info(f"✅ API #{key_index + 1}: {model_name}")
+                entry["model"] = model_name
+                entry["refresh_failures"] = 0
+                entry["next_refresh_at"] = 0.0
+                remember_working(task, model_name)
+                return True
+        
+        pause = min(KEY_REFRESH_INTERVAL * 2 ** entry["refresh_failures"], QUOTA_MAX_COOLDOWN)
+        entry["refresh_failures"] += 1
+        entry["next_refresh_at"] = time.monotonic() + pause
+        publish_state("refresh", str(key_index), time.time() + pause, ttl=pause)
+        log.warning(f"⚠️ API #{key_index + 1}: рабочей модели нет, следующая проверка через {int(pause)} сек")
+    
+    return False
+
+async def init_bot_identity() -> types.User:
+    """Запрашивает данные бота один раз и готовит шаблон упоминания."""
+    global BOT_USER, BOT_MENTION_RE
+    
+    BOT_USER = await bot.get_me()
+    BOT_MENTION_RE = re.compile(rf"@{re.escape(BOT_USER.username)}\b", re.IGNORECASE)
+    log.info(f"🤖 Бот: @{BOT_USER.username}")
+    return BOT_USER
+
+def strip_bot_mention(text: str) -> str:
+    """Убирает @username бота из текста."""
+    return BOT_MENTION_RE.sub("", text).strip()
+
 async def is_addressed_to_bot(message: Message, bot_user: types.User):
-    """Проверяет, адресовано ли сообщение боту."""
+    """Проверяет, адресовано ли сообщение боту (без запросов к Telegram)."""
     if message.chat.type == "private":
         return True
-    if message.reply_to_message and message.reply_to_message.from_user.id == bot_user.id:
+    reply = message.reply_to_message
+    if reply and reply.from_user and reply.from_user.id == bot_user.id:
         return True
-    if message.text and f"@{bot_user.username}" in message.text:
+    if message.text and BOT_MENTION_RE.search(message.text):
         return True
-    if message.caption and f"@{bot_user.username}" in message.caption:
+    if message.caption and BOT_MENTION_RE.search(message.caption):
         return True
     return False
 
-async def prepare_prompt_parts(message: Message, bot_user: types.User) -> Tuple[List, List]:
-    """Подготавливает части промта и список временных файлов для удаления."""
+# --- ПОДГОТОВКА ФОТО ---
+def pick_photo_size(sizes: List[types.PhotoSize]) -> types.PhotoSize:
+    """Самый маленький вариант фото, который не меньше PHOTO_TARGET_SIDE (иначе самый большой)."""
+    for size in sorted(sizes, key=lambda p: p.width * p.height):
+        if max(size.width, size.height) >= PHOTO_TARGET_SIDE:
+            return size
+    return max(sizes, key=lambda p: p.width * p.height)
+
+def preprocess_image(raw: bytes) -> Dict[str, object]:
+    """Уменьшает и пережимает фото для Gemini (блокирующий вызов, запускать в потоке).
+    
+    JPEG декодируется сразу в уменьшенном масштабе через draft(), прочие форматы
+    грубо ужимаются reduce() до финального ресайза.
+    """
+    image = Image.open(BytesIO(raw))
+    target = (PHOTO_TARGET_SIDE, PHOTO_TARGET_SIDE)
+    
+    if image.format == "JPEG":
+        image.draft("RGB", target)
+    else:
+        factor = max(image.size) // PHOTO_TARGET_SIDE
+        if factor >= 2:
+            image = image.reduce(factor)
+    
+    image.thumbnail(target, Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        # Прозрачность (стикеры) - на белый фон, а не в чёрный
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    
+    output = BytesIO()
+    image.save(output, format=PHOTO_FORMAT, quality=PHOTO_QUALITY, optimize=True)
+    return {"mime_type": f"image/{PHOTO_FORMAT.lower()}", "data": output.getvalue()}
+
+def prepare_image_entry(raw: bytes, file_unique_id: str) -> Dict[str, object]:
+    """Готовит фото и ключ кэша ответов (блокирующий вызов, запускать в потоке)."""
+    part = preprocess_image(raw)
+    # Только точная идентичность файла: похожие на вид картинки (скриншоты текста
+    # на белом фоне) могут требовать совсем разных ответов
+    return {"part": part, "key": f"uid:{file_unique_id}"}
+
+async def load_image_part(media) -> Dict[str, object]:
+    """Подготовленное фото/стикер: из кэша по file_unique_id или со скачиванием."""
+    global IMAGE_CACHE_USED
+    
+    entry = IMAGE_CACHE.get(media.file_unique_id)
+    if entry is not None:
+        IMAGE_CACHE.move_to_end(media.file_unique_id)
+        inc_metric("bot_cache_hits_total", cache="image")
+        log.debug(f"♻️ Фото из кэша, без скачивания")
+        return entry
+    
+    inc_metric("bot_cache_misses_total", cache="image")
+    img_data = BytesIO()
+    async with MEDIA_SEMAPHORE:
+        file_info = await bot.get_file(media.file_id)
+        await bot.download_file(file_info.file_path, img_data)
+    
+    # Декодирование и ресайз - в потоке, чтобы не блокировать event loop
+    entry = await asyncio.to_thread(prepare_image_entry, img_data.getvalue(), media.file_unique_id)
+    
+    IMAGE_CACHE[media.file_unique_id] = entry
+    IMAGE_CACHE_USED += len(entry["part"]["data"])
+    while IMAGE_CACHE_USED > IMAGE_CACHE_BYTES and IMAGE_CACHE:
+        _, evicted = IMAGE_CACHE.popitem(last=False)
+        IMAGE_CACHE_USED -= len(evicted["part"]["data"])
+    return entry
+
+def response_state_key(cache_key: Tuple) -> str:
+    """Ключ кэша ответов в общем хранилище."""
+    return hashlib.sha1(json.dumps(cache_key, ensure_ascii=False).encode()).hexdigest()
+
+def _remember_response(cache_key: Tuple, response_text: str, stored_at: float):
+    RESPONSE_CACHE[cache_key] = (stored_at, response_text)
+    RESPONSE_CACHE.move_to_end(cache_key)
+    while len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+
+async def get_cached_response(cache_key: Optional[Tuple]) -> Optional[str]:
+    """Ответ модели на такой же запрос с той же картинкой, если он ещё свежий.
+    Сначала своя память, затем общее хранилище (ответ другого процесса)."""
+    if cache_key is None:
+        return None
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        stored_at, response_text = cached
+        if time.monotonic() - stored_at <= RESPONSE_CACHE_TTL:
+            RESPONSE_CACHE.move_to_end(cache_key)
+            inc_metric("bot_cache_hits_total", cache="response")
+            return response_text
+        del RESPONSE_CACHE[cache_key]
+    
+    shared = await state_get("responses", response_state_key(cache_key))
+    response_text = None
+    if isinstance(shared, dict):
+        # Возраст считаем от записи в хранилище: чужой ответ не должен жить дольше RESPONSE_CACHE_TTL
+        age = time.time() - shared["at"]
+        if age <= RESPONSE_CACHE_TTL:
+            response_text = shared["text"]
+            _remember_response(cache_key, response_text, time.monotonic() - max(age, 0))
+    if response_text:
+        inc_metric("bot_cache_hits_total", cache="response")
+    else:
+        inc_metric("bot_cache_misses_total", cache="response")
+    return response_text
+
+def store_cached_response(cache_key: Optional[Tuple], response_text: str):
+    """Запоминает ответ модели (только для запросов с картинкой)."""
+    if cache_key is None:
+        return
+    _remember_response(cache_key, response_text, time.monotonic())
+    publish_state("responses", response_state_key(cache_key), {"at": time.time(), "text": response_text},
+                  ttl=RESPONSE_CACHE_TTL)
+
+async def prepare_prompt_parts(message: Message, bot_user: types.User) -> Tuple[List, List, Optional[str]]:
+    """Подготавливает части промта, список временных файлов для удаления
+    и ключ картинки для кэша ответов (None, если картинки нет)."""
     prompt_parts = []
     temp_files_to_delete = []
+    image_key = None
     
     text_content = ""
     if message.text:
-        text_content = message.text.replace(f"@{bot_user.username}", "").strip()
+        text_content = strip_bot_mention(message.text)
     elif message.caption:
-        text_content = message.caption.replace(f"@{bot_user.username}", "").strip()
+        text_content = strip_bot_mention(message.caption)
     
     if text_content:
         prompt_parts.append(text_content)
     
+    media = None
     if message.photo:
+        media = pick_photo_size(message.photo)
+        log.debug(f"📸 Загружаю фото {media.width}x{media.height}...")
+    elif message.sticker:
+        sticker = message.sticker
+        # Анимированные/видео стикеры - по превью
+        media = sticker if not (sticker.is_animated or sticker.is_video) else sticker.thumbnail
+        if media:
+            log.debug(f"📸 Загружаю стикер...")
+    
+    if media:
         try:
-            print(f"📸 Загружаю фото...")
-            photo_id = message.photo[-1].file_id
-            file_info = await bot.get_file(photo_id)
-            img_data = BytesIO()
-            await bot.download_file(file_info.file_path, img_data)
-            img_data.seek(0)
-            image = Image.open(img_data)
+            entry = await load_image_part(media)
+            image_key = entry["key"]
             
-            prompt_parts.append(image)
-            print(f"✅ Фото добавлено")
+            prompt_parts.append(entry["part"])
+            log.debug(f"✅ Фото добавлено ({len(entry['part']['data']) // 1024} КБ)")
+        except Exception as e:
+            log.error(f"❌ Ошибка фото: {e}")
+    
+    return prompt_parts, temp_files_to_delete, image_key
+
+# --- 🎙️ СИНТЕЗ РЕЧИ В ПАМЯТЬ ---
+async def synthesize_speech(text: str, voice: str, rate: str = TTS_RATE) -> Tuple[Optional[bytes], Optional[str]]:
+    """Синтезирует речь потоком edge-tts в память.
+    
+    Возвращает (аудио, None); если аудио больше TTS_SPILL_BYTES, оно дописывается
+    во временный файл и возвращается (None, путь).
+    """
+    buffer = BytesIO()
+    spill = None
+    communicate = edge_tts.Communicate(text, voice, rate=rate)
+    
+    audio_bytes = 0
+    try:
+        async with TTS_SEMAPHORE:
+            started = time.monotonic()
+            with trace_span("tts", voice=voice) as span:
+                async for chunk in communicate.stream():
+                    if chunk["type"] != "audio":
+                        continue
+                    audio_bytes += len(chunk["data"])
+                    if spill is None and buffer.tell() + len(chunk["data"]) > TTS_SPILL_BYTES:
+                        spill = tempfile.NamedTemporaryFile(prefix="voice_", suffix=".mp3", delete=False)
+                        spill.write(buffer.getvalue())
+                        buffer = None
+                    if spill is not None:
+                        spill.write(chunk["data"])
+                    else:
+                        buffer.write(chunk["data"])
+                if span is not None:
+                    span["attributes"]["bytes"] = audio_bytes
+            observe_metric("bot_tts_latency_seconds", time.monotonic() - started)
+            observe_metric("bot_tts_bytes", audio_bytes)
+    except Exception:
+        if spill is not None:
+            spill.close()
+            remove_spill_file(spill.name)
+        raise
+    
+    if spill is not None:
+        spill.close()
+        return None, spill.name
+    return buffer.getvalue(), None
+
+def make_voice_file(audio: Optional[bytes], spill_path: Optional[str]):
+    """Готовит аудио к отправке в Telegram без записи на диск."""
+    if spill_path:
+        return FSInputFile(spill_path, filename="voice.mp3")
+    return BufferedInputFile(audio, filename="voice.mp3")
+
+def remove_spill_file(spill_path: Optional[str]):
+    """Удаляет временный файл аудио, если он был."""
+    if spill_path and os.path.exists(spill_path):
+        try:
+            os.remove(spill_path)
+        except:
+            pass
+
+# --- 🎙️ КЭШ ОЗВУЧКИ ---
+def tts_cache_key(text: str, voice: str, rate: str = TTS_RATE) -> str:
+    """Ключ кэша озвучки: голос, скорость и нормализованный текст."""
+    normalized = " ".join(clean_text_for_speech(text).split())
+    return hashlib.sha256(f"{voice}|{rate}|{normalized}".encode("utf-8")).hexdigest()
+
+def _tts_disk_path(cache_key: str) -> str:
+    return os.path.join(TTS_CACHE_DIR, f"{cache_key}.mp3")
+
+def _read_tts_disk(cache_key: str) -> Optional[bytes]:
+    """Читает аудио с диска (в потоке)."""
+    try:
+        with open(_tts_disk_path(cache_key), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write_tts_disk(cache_key: str, audio: bytes):
+    """Пишет аудио на диск и выселяет самые старые файлы сверх лимита (в потоке)."""
+    global TTS_DISK_BYTES
+    
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    files = None
+    if TTS_DISK_BYTES is None:
+        files = [e for e in os.scandir(TTS_CACHE_DIR) if e.name.endswith(".mp3")]
+        TTS_DISK_BYTES = sum(e.stat().st_size for e in files)
+    
+    path = _tts_disk_path(cache_key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(audio)
+    os.replace(tmp_path, path)
+    TTS_DISK_BYTES += len(audio)
+    
+    if TTS_DISK_BYTES <= TTS_CACHE_DISK_BYTES:
+        return
+    
+    files = [e for e in os.scandir(TTS_CACHE_DIR) if e.name.endswith(".mp3")]
+    files.sort(key=lambda e: e.stat().st_mtime)
+    TTS_DISK_BYTES = sum(e.stat().st_size for e in files)
+    for old in files:
+        if TTS_DISK_BYTES <= TTS_CACHE_DISK_BYTES:
+            break
+        try:
+            size = old.stat().st_size
+            os.remove(old.path)
+            TTS_DISK_BYTES -= size
+        except OSError:
+            pass
+
+def _store_tts_memory(cache_key: str, audio: bytes):
+    """Кладёт аудио в LRU в памяти с лимитом по байтам."""
+    global TTS_CACHE_BYTES
+    
+    if len(audio) > TTS_CACHE_MEMORY_BYTES:
+        return
+    old = TTS_CACHE.pop(cache_key, None)
+    if old is not None:
+        TTS_CACHE_BYTES -= len(old)
+    TTS_CACHE[cache_key] = audio
+    TTS_CACHE_BYTES += len(audio)
+    while TTS_CACHE_BYTES > TTS_CACHE_MEMORY_BYTES:
+        _, evicted = TTS_CACHE.popitem(last=False)
+        TTS_CACHE_BYTES -= len(evicted)
+
+async def get_cached_audio(cache_key: str) -> Optional[bytes]:
+    """Ищет аудио в памяти, затем на диске."""
+    audio = TTS_CACHE.get(cache_key)
+    if audio is not None:
+        TTS_CACHE.move_to_end(cache_key)
+        return audio
+    if TTS_CACHE_DIR:
+        audio = await asyncio.to_thread(_read_tts_disk, cache_key)
+        if audio is not None:
+            _store_tts_memory(cache_key, audio)
+    return audio
+
+async def store_cached_audio(cache_key: str, audio: bytes):
+    """Сохраняет аудио в кэш (память + диск, если включён)."""
+    _store_tts_memory(cache_key, audio)
+    if TTS_CACHE_DIR:
+        try:
+            await asyncio.to_thread(_write_tts_disk, cache_key, audio)
+        except OSError as e:
+            log.warning(f"⚠️ Кэш озвучки на диске недоступен: {e}")
+
+def remember_voice_file_id(cache_key: str, sent: Optional[Message]):
+    """Запоминает file_id загруженного голоса для повторной отправки без загрузки."""
+    media = getattr(sent, "voice", None) or getattr(sent, "audio", None)
+    if not media:
+        return
+    _remember_file_id(cache_key, media.file_id)
+    publish_state("voice", cache_key, media.file_id)
+
+def _remember_file_id(cache_key: str, file_id: str):
+    TTS_FILE_IDS[cache_key] = file_id
+    TTS_FILE_IDS.move_to_end(cache_key)
+    while len(TTS_FILE_IDS) > TTS_FILE_ID_CACHE_SIZE:
+        TTS_FILE_IDS.popitem(last=False)
+
+async def get_voice_file_id(cache_key: str) -> Optional[str]:
+    """file_id голоса: из памяти или загруженный другим процессом."""
+    file_id = TTS_FILE_IDS.get(cache_key)
+    if file_id is None:
+        file_id = await state_get("voice", cache_key)
+        if file_id:
+            _remember_file_id(cache_key, file_id)
+    return file_id
+
+async def send_voice_cached(send, text: str, voice: str, rate: str = TTS_RATE) -> Message:
+    """Озвучивает text и отправляет через send(voice) с минимумом работы.
+    
+    Порядок: file_id уже загруженного голоса -> аудио из кэша -> синтез edge-tts.
+    """
+    cache_key = tts_cache_key(text, voice, rate)
+    
+    file_id = await get_voice_file_id(cache_key)
+    if file_id:
+        try:
+            started = time.monotonic()
+            with trace_span("reply_voice", kind="file_id"):
+                sent = await send(file_id)
+            observe_metric("bot_telegram_upload_seconds", time.monotonic() - started, kind="file_id")
+            inc_metric("bot_cache_hits_total", cache="voice_file_id")
+            TTS_FILE_IDS.move_to_end(cache_key)
+            log.debug(f"♻️ Голос по file_id, без загрузки")
+            return sent
         except Exception as e:
-            print(f"❌ Ошибка фото: {e}")
+            log.warning(f"⚠️ file_id не принят, загружаю заново: {e}")
+            TTS_FILE_IDS.pop(cache_key, None)
     
-    return prompt_parts, temp_files_to_delete
+    spill_path = None
+    try:
+        audio = await get_cached_audio(cache_key)
+        if audio is not None:
+            inc_metric("bot_cache_hits_total", cache="tts_audio")
+            log.debug(f"♻️ Аудио из кэша")
+        else:
+            inc_metric("bot_cache_misses_total", cache="tts_audio")
+            audio, spill_path = await synthesize_speech(text, voice, rate)
+            log.debug(f"✅ Аудио создано")
+            if audio is not None:
+                await store_cached_audio(cache_key, audio)
+        
+        started = time.monotonic()
+        with trace_span("reply_voice", kind="upload"):
+            sent = await send(make_voice_file(audio, spill_path))
+        observe_metric("bot_telegram_upload_seconds", time.monotonic() - started, kind="upload")
+        remember_voice_file_id(cache_key, sent)
+        return sent
+    finally:
+        remove_spill_file(spill_path)
 
 # --- 🎙️ ФУНКЦИЯ ОЗВУЧКИ И ОТПРАВКИ (РЕЖИМ ARCHIVER) ---
-async def send_dual_response(message: Message, text_ru: str, text_az: str):
-    """Отправляет голосовое сообщение с РУССКИМ текстом ВСЕГДА."""
+async def send_dual_response(message: Message, text_ru: str, text_az: str,
+                             with_caption: bool = True) -> Optional[Message]:
+    """Отправляет голосовое сообщение с РУССКИМ текстом ВСЕГДА.
     
-    filename = f"voice_{message.message_id}.mp3"
+    with_caption=False - текст уже отправлен отдельно (потоковый режим).
+    Возвращает отправленное голосовое (None, если не вышло).
+    """
     
     try:
-        # ВЫБИРАЕМ ЯЗЫК ОЗВУЧКИ
-        if CURRENT_VOICE == "ru":
+        # ВЫБИРАЕМ ЯЗЫК ОЗВУЧКИ (ПО НАСТРОЙКАМ ЧАТА)
+        settings = await get_chat_settings(message.chat.id)
+        if settings["voice"] == "ru":
             VOICE = VOICES["ru"]
             clean_text_for_voice = clean_text_for_speech(text_ru)
             
             if len(clean_text_for_voice) > 500:
                 clean_text_for_voice = clean_text_for_voice[:500]
             
-            print(f"🎤 Синтезирую голос (Svetlana - ru-RU)...")
-            print(f"   Озвучиваю: {clean_text_for_voice[:60]}...")
-            
-            communicate = edge_tts.Communicate(clean_text_for_voice, VOICE, rate="+5%")
+            log.debug(f"🎤 Синтезирую голос (Svetlana - ru-RU)")
         
         else:  # AZ
             VOICE = VOICES["az"]
@@ -411,43 +2394,27 @@ async def send_dual_response(message: Message, text_ru: str, text_az: str):
             if len(clean_text_for_voice) > 500:
                 clean_text_for_voice = clean_text_for_voice[:500]
             
-            print(f"🎤 Синтезирую голос (Banu - az-AZ)...")
-            print(f"   Озвучиваю: {clean_text_for_voice[:60]}...")
-            
-            communicate = edge_tts.Communicate(clean_text_for_voice, VOICE, rate="+5%")
-        
-        # ОЗВУЧКА
-        await communicate.save(filename)
-        print(f"✅ Аудио создано")
-        
-        # ✅✅✅ ОТПРАВЛЯЕМ - ТЕКСТ ВСЕГДА РУССКИЙ!
-        voice_file = FSInputFile(filename)
+            log.debug(f"🎤 Синтезирую голос (Banu - az-AZ)")
         
-        print(f"📤 Отправляю голос с текстом:\n{text_ru}")
+        log_payload("🎤 Озвучиваю", clean_text_for_voice)
         
-        await message.reply_voice(
-            voice=voice_file,
-            caption=text_ru  # ✅ РУССКИЙ! БЕЗ УСЛОВИЙ!
+        # ОЗВУЧКА + ✅✅✅ ОТПРАВЛЯЕМ - ТЕКСТ ВСЕГДА РУССКИЙ!
+        sent = await send_voice_cached(
+            lambda voice_file: message.reply_voice(
+                voice=voice_file,
+                caption=text_ru if with_caption else None  # ✅ РУССКИЙ! БЕЗ УСЛОВИЙ!
+            ),
+            clean_text_for_voice, VOICE
         )
-        print(f"✅ Голос + текст отправлены!")
+        log.info(f"✅ Голос + текст отправлены")
+        return sent
         
     except Exception as e:
-        print(f"❌ Ошибка озвучки: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    finally:
-        if os.path.exists(filename):
-            try:
-                os.remove(filename)
-            except:
-                pass
+        log.exception(f"❌ Ошибка озвучки: {e}")
 
 # --- 🎙️ ФУНКЦИЯ ОЗВУЧКИ ДЛЯ ПОМОЩНИКА (NORMAL MODE) ---
-async def send_normal_response(message: Message, text: str):
-    """Отправляет ответ помощника голосом (русский Svetlana)."""
-    
-    filename = f"voice_{message.message_id}.mp3"
+async def send_normal_response(message: Message, text: str, with_caption: bool = True) -> Optional[Message]:
+    """Отправляет ответ помощника голосом (русский Svetlana). Возвращает отправленное голосовое."""
     
     try:
         # ТОЧНО КАК В send_dual_response, но для NORMAL режима
@@ -458,40 +2425,30 @@ async def send_normal_response(message: Message, text: str):
         if len(clean_text_for_voice) > 500:
             clean_text_for_voice = clean_text_for_voice[:500]
         
-        print(f"🎤 Синтезирую голос помощника (Svetlana - ru-RU)...")
-        print(f"   Озвучиваю: {clean_text_for_voice[:60]}...")
-        
-        # ТОЧНО ТАКАЯ ЖЕ ОЗВУЧКА КАК В /ru
-        communicate = edge_tts.Communicate(clean_text_for_voice, VOICE, rate="+5%")
-        await communicate.save(filename)
-        print(f"✅ Аудио создано")
-        
-        voice_file = FSInputFile(filename)
+        log.debug(f"🎤 Синтезирую голос помощника (Svetlana - ru-RU)")
+        log_payload("🎤 Озвучиваю", clean_text_for_voice)
         
-        print(f"📤 Отправляю голос с текстом:\n{text}")
-        
-        # ОТПРАВЛЯЕМ ТОЧНО КАК В send_dual_response
-        await message.reply_voice(
-            voice=voice_file,
-            caption=text
+        # ТОЧНО ТАКАЯ ЖЕ ОЗВУЧКА И ОТПРАВКА КАК В send_dual_response
+        sent = await send_voice_cached(
+            lambda voice_file: message.reply_voice(
+                voice=voice_file,
+                caption=text if with_caption else None
+            ),
+            clean_text_for_voice, VOICE
         )
-        print(f"✅ Голос + текст отправлены!")
+        log.info(f"✅ Голос + текст отправлены")
+        return sent
         
     except Exception as e:
-        print(f"❌ Ошибка озвучки: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    finally:
-        if os.path.exists(filename):
-            try:
-                os.remove(filename)
-            except:
-                pass
+        log.exception(f"❌ Ошибка озвучки: {e}")
 
 # --- ФУНКЦИИ МОНИТОРИНГА ---
-def save_user_message(user_name: str, user_id: int, username: str, message_text: str):
-    """Сохраняет сообщение пользователя в JSON файл."""
+async def save_user_message(user_name: str, user_id: int, username: str, message_text: str):
+    """Сохраняет сообщение пользователя: в общее хранилище процессов или в JSON файл.
+    
+    Пользователь пишет в разные чаты, а чаты разнесены по воркерам - поэтому
+    при нескольких процессах файл не годится (одновременная перезапись теряет сообщения).
+    """
     
     filename = os.path.join(MESSAGES_DIR, f"{user_name}_messages.json")
     
@@ -501,6 +2458,11 @@ def save_user_message(user_name: str, user_id: int, username: str, message_text:
         "text": message_text
     }
     
+    if STATE is not None:
+        await asyncio.to_thread(STATE.append_collected, user_name, message_data)
+        log.debug(f"💾 Сообщение сохранено от {user_name} (@{username})")
+        return
+    
     messages = []
     if os.path.exists(filename):
         try:
@@ -514,11 +2476,14 @@ def save_user_message(user_name: str, user_id: int, username: str, message_text:
     with open(filename, "w", encoding="utf-8") as f:
         json.dump(messages, f, ensure_ascii=False, indent=2)
     
-    print(f"💾 Сообщение сохранено от {user_name} (@{username})")
+    log.debug(f"💾 Сообщение сохранено от {user_name} (@{username})")
 
-def get_collected_messages(user_name: str) -> List[str]:
+async def get_collected_messages(user_name: str) -> List[str]:
     """Возвращает все собранные сообщения пользователя за день."""
     
+    if STATE is not None:
+        return [msg["text"] for msg in await asyncio.to_thread(STATE.collected, user_name)]
+    
     filename = os.path.join(MESSAGES_DIR, f"{user_name}_messages.json")
     
     if not os.path.exists(filename):
@@ -531,27 +2496,30 @@ def get_collected_messages(user_name: str) -> List[str]:
     except:
         return []
 
-def clear_daily_messages(user_name: str):
+async def clear_daily_messages(user_name: str):
     """Очищает собранные сообщения после отправки отчета."""
     
+    if STATE is not None:
+        await asyncio.to_thread(STATE.clear_collected, user_name)
+        log.info(f"🗑️ Очищены сообщения для {user_name}")
+        return
+    
     filename = os.path.join(MESSAGES_DIR, f"{user_name}_messages.json")
     
     if os.path.exists(filename):
         try:
             os.remove(filename)
-            print(f"🗑️ Очищены сообщения для {user_name}")
+            log.info(f"🗑️ Очищены сообщения для {user_name}")
         except:
             pass
 
 async def generate_user_report(user_name: str) -> Tuple[Optional[str], Optional[str]]:
     """Генерирует анализ сообщений пользователя через /az модель."""
     
-    global ACTIVE_MODEL_NAME
-    
-    messages = get_collected_messages(user_name)
+    messages = await get_collected_messages(user_name)
     
     if not messages:
-        print(f"⚠️ Нет сообщений для {user_name}")
+        log.warning(f"⚠️ Нет сообщений для {user_name}")
         return None, None
     
     context = "\n".join(messages)
@@ -568,31 +2536,25 @@ async def generate_user_report(user_name: str) -> Tuple[Optional[str], Optional[
 Дай острый анализ этого человека. Что о нем говорит его речь? Какой он на самом деле?"""
     
     try:
-        print(f"📊 Генерирую отчет для {user_name}...")
-        
-        current_model = genai.GenerativeModel(
-            model_name=ACTIVE_MODEL_NAME,
-            generation_config=generation_config,
-            system_instruction=SYSTEM_PROMPT_REPORT
-        )
+        log.info(f"📊 Генерирую отчет для {user_name}...")
         
-        response = await current_model.generate_content_async(analysis_prompt)
+        response = await generate_with_failover(SYSTEM_PROMPT_REPORT, analysis_prompt, profile="report")
+        if response is None:
+            log.error(f"❌ Нет доступных API для отчета")
+            return None, None
         
-        if response.text:
-            return parse_dual_response(response.text)
+        report_text = get_response_text(response)
+        if report_text:
+            return parse_dual_response(report_text)
     
     except Exception as e:
-        print(f"❌ Ошибка генерации отчета: {e}")
-        if await switch_api_key(silent=True):
-            return await generate_user_report(user_name)
+        log.error(f"❌ Ошибка генерации отчета: {e}")
     
     return None, None
 
 async def send_report_voice(user_name: str, user_id: int, text_ru: str, text_az: str):
     """Отправляет голосовой отчет в группу."""
     
-    filename = f"report_{user_name}_{int(time.time())}.mp3"
-    
     try:
         VOICE = VOICES["az"]  # /az модель - азербайджанский голос
         clean_text = clean_text_for_speech(text_az)
@@ -600,36 +2562,24 @@ async def send_report_voice(user_name: str, user_id: int, text_ru: str, text_az:
         if len(clean_text) > 500:
             clean_text = clean_text[:500]
         
-        print(f"🎤 Синтезирую отчет для {user_name} (az-AZ)...")
-        
-        communicate = edge_tts.Communicate(clean_text, VOICE, rate="+5%")
-        await communicate.save(filename)
-        
-        print(f"✅ Аудио отчета создано для {user_name}")
-        
-        voice_file = FSInputFile(filename)
+        log.debug(f"🎤 Синтезирую отчет для {user_name} (az-AZ)...")
         
         try:
             # ОТПРАВЛЯЕМ В ГРУППУ, А НЕ В ЛС
-            await bot.send_voice(
-                chat_id=REPORT_GROUP_ID,  # ← ГРУППА ВМЕСТО user_id
-                voice=voice_file,
-                caption=f"📊 *Отчет о {user_name}* (@{MONITORED_USERS[user_name]['username']})\n\n{text_ru}"
+            await send_voice_cached(
+                lambda voice_file: bot.send_voice(
+                    chat_id=REPORT_GROUP_ID,  # ← ГРУППА ВМЕСТО user_id
+                    voice=voice_file,
+                    caption=f"📊 *Отчет о {user_name}* (@{MONITORED_USERS[user_name]['username']})\n\n{text_ru}"
+                ),
+                clean_text, VOICE
             )
-            print(f"📤 Отчет отправлен в группу для {user_name}")
+            log.info(f"📤 Отчет отправлен в группу для {user_name}")
         except Exception as e:
-            print(f"⚠️ Не удалось отправить отчет в группу: {e}")
-            logging.error(f"Failed to send report to group: {e}")
+            log.warning(f"⚠️ Не удалось отправить отчет в группу: {e}")
     
     except Exception as e:
-        print(f"❌ Ошибка озвучки отчета: {e}")
-    
-    finally:
-        if os.path.exists(filename):
-            try:
-                os.remove(filename)
-            except:
-                pass
+        log.error(f"❌ Ошибка озвучки отчета: {e}")
 
 async def send_daily_reports():
     """Отправляет отчеты в 21:00 МСК в группу."""
@@ -638,9 +2588,7 @@ async def send_daily_reports():
         now = datetime.now(MSK_TZ)
         
         if now.hour == 21 and now.minute == 0:
-            print(f"\n{'='*60}")
-            print(f"⏰ ВРЕМЯ ОТЧЕТОВ! {now.strftime('%H:%M:%S МСК')}")
-            print(f"{'='*60}\n")
+            log.info(f"⏰ Время отчетов: {now.strftime('%H:%M:%S МСК')}")
             
             report_count = 0
             
@@ -648,156 +2596,208 @@ async def send_daily_reports():
                 user_id = user_data["id"]
                 username = user_data["username"]
                 
-                print(f"\n🔍 Обработка {user_name}...")
-                
-                messages = get_collected_messages(user_name)
-                print(f"   📝 Собрано сообщений: {len(messages)}")
-                
-                if messages:
-                    for i, msg in enumerate(messages[:5]):  # Показываем первые 5
-                        print(f"      - {msg[:60]}...")
+                messages = await get_collected_messages(user_name)
+                log.info(f"🔍 Отчет для {user_name}: собрано сообщений {len(messages)}")
                 
                 text_ru, text_az = await generate_user_report(user_name)
                 
                 if text_ru and text_az:
-                    print(f"\n   ✅ Отчет готов!")
-                    print(f"   RU: {text_ru}")
-                    print(f"   AZ: {text_az}")
+                    log.info(f"✅ Отчет для {user_name} готов")
+                    log_payload("RU", text_ru)
+                    log_payload("AZ", text_az)
                     
                     if not contains_forbidden_words(text_az):
                         try:
                             await send_report_voice(user_name, user_id, text_ru, text_az)
                             report_count += 1
                         except Exception as e:
-                            print(f"   ❌ Ошибка отправки: {e}")
+                            log.error(f"❌ Ошибка отправки отчета: {e}")
                     else:
-                        print(f"   ⚠️ Запретные слова обнаружены!")
+                        log.warning(f"⚠️ Запретные слова в отчете для {user_name}")
                     
-                    clear_daily_messages(user_name)
+                    await clear_daily_messages(user_name)
                 else:
-                    print(f"   ⚠️ Не удалось сгенерировать отчет")
-                    if not messages:
-                        print(f"      (нет сообщений за день)")
-                    clear_daily_messages(user_name)
+                    log.warning(f"⚠️ Не удалось сгенерировать отчет для {user_name}"
+                                + ("" if messages else " (нет сообщений за день)"))
+                    await clear_daily_messages(user_name)
             
-            print(f"\n{'='*60}")
-            print(f"✅ ОТЧЕТЫ ОТПРАВЛЕНЫ: {report_count}/2")
-            print(f"{'='*60}\n")
+            log.info(f"✅ Отчеты отправлены: {report_count}/{len(MONITORED_USERS)}")
             
             await asyncio.sleep(60)
         
         await asyncio.sleep(30)
 
 async def process_with_retry(message: Message, bot_user: types.User, text_content: str, 
-                             prompt_parts: List, temp_files: List):
+                             prompt_parts: List, temp_files: List, image_key: Optional[str] = None):
     """Пробует обработать сообщение с переключением моделей и API при необходимости."""
-    global ACTIVE_MODEL, ACTIVE_MODEL_NAME, CURRENT_API_KEY_INDEX, CURRENT_MODE
-    
+    early_reply_task = None  # отправка RU текста до конца генерации (потоковый режим)
     try:
-        # ВЫБИРАЕМ ПРОМПТ ПО РЕЖИМУ
-        if CURRENT_MODE == "normal":
+        # ВЫБИРАЕМ ПРОМПТ ПО РЕЖИМУ ЧАТА
+        mode = (await get_chat_settings(message.chat.id))["mode"]
+        if mode == "normal":
             system_prompt = SYSTEM_PROMPT_NORMAL
-            print(f"⚖️ РЕЖИМ: ПОМОЩНИК")
+            log.debug(f"⚖️ РЕЖИМ: ПОМОЩНИК")
         else:
             system_prompt = detect_system_prompt(text_content)
-            if CURRENT_MODE == "archiver_ru":
-                print(f"🔥 РЕЖИМ: АРХИТЕКТОРША НА РУСИ")
+            if mode == "archiver_ru":
+                log.debug(f"🔥 РЕЖИМ: АРХИТЕКТОРША НА РУСИ")
             else:
-                print(f"🔥 РЕЖИМ: КОРОЛЕВА ИЗ КАРАБАХА")
+                log.debug(f"🔥 РЕЖИМ: КОРОЛЕВА ИЗ КАРАБАХА")
         
         if not prompt_parts:
             return
+        
+        # ПАМЯТЬ ДИАЛОГА: прошлые реплики и цепочка ответов - в запрос, текущее сообщение - в историю
+        use_history = mode in HISTORY_MODES
+        contents = prompt_parts
+        if use_history:
+            contents = await build_history_contents(message, prompt_parts)
+            reply_to = message.reply_to_message.message_id if message.reply_to_message else None
+            remember_turn(message.chat.id, message.message_id, reply_to, "user", history_text(message, text_content))
+        
+        def remember_answer(sent: Optional[Message], text: str):
+            if use_history:
+                remember_turn(message.chat.id, sent.message_id if sent else None, message.message_id, "model", text)
 
-        print(f"🚀 Запрос в {ACTIVE_MODEL_NAME}")
+        # ПОТОКОВЫЙ РЕЖИМ: RU текст уходит сразу, голос - после синтеза
+        early_reply = None
         
-        current_model = genai.GenerativeModel(
-            model_name=ACTIVE_MODEL_NAME,
-            generation_config=generation_config,
-            system_instruction=system_prompt
-        )
+        async def on_chunk(partial_text: str):
+            nonlocal early_reply_task
+            if early_reply_task is not None:
+                return
+            text_ru = extract_streamed_ru(partial_text)
+            if text_ru:
+                # Отдельной задачей: ошибка Telegram не должна обрывать генерацию
+                # и засчитываться паре ключ/модель как сбой
+                # (reply() отдаёт awaitable SendMessage, а не корутину - create_task его не примет)
+                early_reply_task = asyncio.ensure_future(message.reply(text_ru))
+        
+        # Та же картинка с тем же текстом в том же режиме - ответ без запроса к Gemini
+        # (если в запросе есть история, ответ от неё зависит - кэш не используем)
+        response_cache_key = (image_key, text_content, mode) if image_key and contents is prompt_parts else None
+        response_text = await get_cached_response(response_cache_key)
+        route = None  # пара ключ/модель, ответившая на этот запрос
         
-        response = await current_model.generate_content_async(prompt_parts)
+        if response_text:
+            log.debug(f"♻️ Ответ из кэша")
+        else:
+            stream_archiver = STREAM_RESPONSES and mode != "normal"
+            response = await generate_with_failover(
+                system_prompt, contents, profile=mode,
+                on_chunk=on_chunk if stream_archiver else None
+            )
+            if response is None:
+                await message.reply("❌ Лимиты исчерпаны")
+                return False
+            
+            response_text = get_response_text(response)
+            route = getattr(response, "route", None)
+            if response_text:
+                store_cached_response(response_cache_key, response_text)
         
-        if response.text:
-            print(f"📨 Ответ получен")
+        if early_reply_task is not None:
+            try:
+                early_reply = await early_reply_task
+                log.debug(f"⚡ RU отправлен до озвучки")
+            except Exception as e:
+                # Не вышло - текст уйдёт подписью к голосовому, как без потока
+                log.warning(f"⚠️ Ранний RU не отправлен: {e}")
+        
+        if response_text:
+            log.debug(f"📨 Ответ получен")
             
             # ЕСЛИ РЕЖИМ NORMAL - ОТПРАВЛЯЕМ С ОЗВУЧКОЙ (БЕЗ ТОКСИКА)
-            if CURRENT_MODE == "normal":
+            if mode == "normal":
                 # Ограничиваем длину ответа
-                answer_text = response.text[:1000]
-                await send_normal_response(message, answer_text)
-                print(f"✅ Помощник ответил!")
+                answer_text = response_text[:1000]
+                text_reply = None
+                if STREAM_RESPONSES:
+                    # Текст не ждёт синтеза речи
+                    text_reply = await message.reply(answer_text)
+                sent = await send_normal_response(message, answer_text, with_caption=not STREAM_RESPONSES)
+                remember_answer(text_reply or sent, answer_text)
+                log.info(f"✅ Помощник ответил!")
                 return True
             
             # ЕСЛИ РЕЖИМ ARCHIVER - ПАРСИМ RU/AZ И ОЗВУЧИВАЕМ
             else:
-                text_ru, text_az = parse_dual_response(response.text)
+                with trace_span("parse"):
+                    text_ru, text_az = parse_dual_response(response_text, expect_json=ARCHIVER_JSON)
+                if route:
+                    # Неразобранный ответ - почти потерянная генерация: роутер это учитывает
+                    record_route_quality(*route, ok=bool(text_ru and text_az))
                 
                 if text_ru and text_az:
-                    print(f"✅ Оба текста найдены")
+                    log.debug(f"✅ Оба текста найдены")
                     
                     # ПРОВЕРКА ЗАПРЕТНЫХ СЛОВ
                     if contains_forbidden_words(text_az):
-                        print(f"⚠️ Обнаружены запретные слова!")
-                        await message.reply("❌ Ответ содержит недопустимый контент.")
+                        log.warning(f"⚠️ Обнаружены запретные слова!")
+                        if early_reply is not None:
+                            await early_reply.edit_text("❌ Ответ содержит недопустимый контент.")
+                        else:
+                            await message.reply("❌ Ответ содержит недопустимый контент.")
                         return
                     
-                    await send_dual_response(message, text_ru, text_az)
+                    sent = await send_dual_response(message, text_ru, text_az, with_caption=early_reply is None)
+                    remember_answer(early_reply or sent, text_ru)
                 
                 elif text_ru:
-                    print(f"⚠️ Только РУ найден")
-                    await message.reply(text_ru)
+                    log.warning(f"⚠️ Только РУ найден")
+                    if early_reply is None:
+                        early_reply = await message.reply(text_ru)
+                    remember_answer(early_reply, text_ru)
                 else:
-                    print(f"⚠️ Парсинг не удался")
-                    await message.reply(response.text)
+                    log.warning(f"⚠️ Парсинг не удался")
+                    await message.reply(response_text)
         else:
+            if route:
+                record_route_quality(*route, ok=False)
             await message.reply("...")
         
         return True
     
+    except asyncio.TimeoutError as e:
+        log.error(f"Gen Timeout: {e}")
+        await message.reply("⏳ Не успела ответить, попробуй ещё раз")
+        return False
+    
     except Exception as e:
-        logging.error(f"Gen Error: {e}")
-        error_str = str(e)
-        
-        if "429" in error_str or "quota" in error_str or "404" in error_str:
-            if ACTIVE_MODEL_NAME not in MODEL_LIMITS:
-                MODEL_LIMITS[ACTIVE_MODEL_NAME] = {}
-            MODEL_LIMITS[ACTIVE_MODEL_NAME][CURRENT_API_KEY_INDEX] = True
-            
-            print(f"⚠️ Лимит")
-            
-            if await find_best_working_model(silent=True):
-                print(f"✅ Новая модель")
-                return await process_with_retry(message, bot_user, text_content, prompt_parts, temp_files)
-            
-            if await switch_api_key(silent=True):
-                print(f"✅ Новый API")
-                return await process_with_retry(message, bot_user, text_content, prompt_parts, temp_files)
-            
-            await message.reply("❌ Лимиты исчерпаны")
-            return False
-        else:
-            await message.reply("❌ Ошибка")
-            return False
+        log.exception(f"Gen Error: {e}")
+        await message.reply("❌ Ошибка")
+        return False
     
     finally:
+        if early_reply_task is not None and not early_reply_task.done():
+            await asyncio.gather(early_reply_task, return_exceptions=True)
         for f_path in temp_files:
             try:
                 os.remove(f_path)
             except:
                 pass
 
+# --- КОНТЕКСТ ЛОГОВ ДЛЯ КАЖДОГО АПДЕЙТА ---
+@dp.update.outer_middleware()
+async def bind_update_context(handler, update: types.Update, data: Dict):
+    """Все записи лога во время обработки апдейта получают id его сообщения."""
+    message = update.message or (update.callback_query.message if update.callback_query else None)
+    if message is not None:
+        bind_request(message.chat.id, message.message_id)
+    else:
+        bind_request(0, update.update_id)
+    sample_payloads()
+    return await handler(update, data)
+
 # --- CALLBACK ХЕНДЛЕРЫ ДЛЯ КНОПОК ---
 @dp.callback_query()
 async def handle_regime_callback(query: CallbackQuery):
     """Обработка нажатий на кнопки режимов."""
-    global CURRENT_MODE, CURRENT_VOICE
-    
     callback_data = query.data
+    chat_id = query.message.chat.id
     
     if callback_data == "regime_ru":
-        CURRENT_MODE = "archiver_ru"
-        CURRENT_VOICE = "ru"
+        set_chat_mode(chat_id, "archiver_ru")
         regime_name = REGIME_NAMES["archiver_ru"]
         
         message_text = (
@@ -808,8 +2808,7 @@ async def handle_regime_callback(query: CallbackQuery):
         )
         
     elif callback_data == "regime_az":
-        CURRENT_MODE = "archiver_az"
-        CURRENT_VOICE = "az"
+        set_chat_mode(chat_id, "archiver_az")
         regime_name = REGIME_NAMES["archiver_az"]
         
         message_text = (
@@ -820,8 +2819,7 @@ async def handle_regime_callback(query: CallbackQuery):
         )
         
     elif callback_data == "regime_norm":
-        CURRENT_MODE = "normal"
-        CURRENT_VOICE = "ru"
+        set_chat_mode(chat_id, "normal")
         regime_name = REGIME_NAMES["normal"]
         
         message_text = (
@@ -841,18 +2839,20 @@ async def handle_regime_callback(query: CallbackQuery):
         )
         await query.answer(f"✅ {regime_name}", show_alert=False)
     except Exception as e:
-        print(f"❌ Ошибка обновления сообщения: {e}")
+        log.error(f"❌ Ошибка обновления сообщения: {e}")
         await query.answer("❌ Ошибка переключения", show_alert=True)
 
 # --- ХЕНДЛЕРЫ КОМАНД (ВАЖНО: ДО ГЛАВНОГО ХЕНДЛЕРА!) ---
 @dp.message(CommandStart())
 async def command_start_handler(message: Message):
-    api_info = f" (API #{CURRENT_API_KEY_INDEX + 1}/{len(GOOGLE_KEYS)})" if len(GOOGLE_KEYS) > 1 else ""
-    status = f"✅ `{ACTIVE_MODEL_NAME}`{api_info}" if ACTIVE_MODEL else "💀 Модель не загружена"
+    active_models = [entry["model"] for entry in KEY_POOL if is_key_healthy(entry)]
+    api_info = f" (API {len(active_models)}/{len(GOOGLE_KEYS)})" if len(GOOGLE_KEYS) > 1 else ""
+    status = f"✅ `{active_models[0]}`{api_info}" if active_models else "💀 Модель не загружена"
     
-    mode_display = REGIME_NAMES.get(CURRENT_MODE, "❓ Неизвестно")
+    settings = await get_chat_settings(message.chat.id)
+    mode_display = REGIME_NAMES.get(settings["mode"], "❓ Неизвестно")
     
-    voice_lang = "🇦🇿 Azərbaycanca (Banu)" if CURRENT_VOICE == "az" else "🇷🇺 Русский (Svetlana)"
+    voice_lang = "🇦🇿 Azərbaycanca (Banu)" if settings["voice"] == "az" else "🇷🇺 Русский (Svetlana)"
     voice_status = f"🎤 {voice_lang}"
     
     commands_info = (
@@ -874,10 +2874,7 @@ async def command_start_handler(message: Message):
 @dp.message(Command("ru"))
 async def switch_to_ru_handler(message: Message):
     """Переключение на режим Архитекторши на Руси через команду"""
-    global CURRENT_MODE, CURRENT_VOICE
-    
-    CURRENT_MODE = "archiver_ru"
-    CURRENT_VOICE = "ru"
+    set_chat_mode(message.chat.id, "archiver_ru")
     regime_name = REGIME_NAMES["archiver_ru"]
     
     await message.answer(
@@ -889,10 +2886,7 @@ async def switch_to_ru_handler(message: Message):
 @dp.message(Command("az"))
 async def switch_to_az_handler(message: Message):
     """Переключение на режим Королевы из Карабаха через команду"""
-    global CURRENT_MODE, CURRENT_VOICE
-    
-    CURRENT_MODE = "archiver_az"
-    CURRENT_VOICE = "az"
+    set_chat_mode(message.chat.id, "archiver_az")
     regime_name = REGIME_NAMES["archiver_az"]
     
     await message.answer(
@@ -904,10 +2898,7 @@ async def switch_to_az_handler(message: Message):
 @dp.message(Command("norm"))
 async def switch_to_norm_handler(message: Message):
     """Переключение на режим Помощника через команду"""
-    global CURRENT_MODE, CURRENT_VOICE
-    
-    CURRENT_MODE = "normal"
-    CURRENT_VOICE = "ru"
+    set_chat_mode(message.chat.id, "normal")
     regime_name = REGIME_NAMES["normal"]
     
     await message.answer(
@@ -916,18 +2907,85 @@ async def switch_to_norm_handler(message: Message):
         reply_markup=get_regime_buttons()
     )
 
+# --- ОЧЕРЕДЬ СООБЩЕНИЙ ПО ЧАТАМ ---
+def enqueue_chat_work(chat_id: int, work):
+    """Ставит работу в FIFO чата. Чат обрабатывается по одному сообщению за раз,
+    поэтому шумный чат не занимает все слоты LLM/TTS у остальных."""
+    queue = CHAT_QUEUES.setdefault(chat_id, deque())
+    if len(queue) >= CHAT_QUEUE_MAX:
+        queue.popleft()
+        inc_metric("bot_dropped_messages_total", reason="chat_queue_full")
+        log.warning(f"🗑️ Очередь чата {chat_id} переполнена, старое сообщение выброшено")
+    # Решение о текстах в логах принято в middleware - передаём его задаче очереди
+    queue.append((time.monotonic(), work, PAYLOAD_SAMPLED.get()))
+    
+    worker = CHAT_WORKERS.get(chat_id)
+    if worker is None or worker.done():
+        CHAT_WORKERS[chat_id] = asyncio.create_task(run_chat_queue(chat_id))
+
+async def run_chat_queue(chat_id: int):
+    """Разбирает очередь чата, пропуская сообщения, которые ждали слишком долго."""
+    queue = CHAT_QUEUES[chat_id]
+    try:
+        while queue:
+            enqueued_at, work, payload_sampled = queue.popleft()
+            waited = time.monotonic() - enqueued_at
+            observe_metric("bot_queue_wait_seconds", waited, queue="chat")
+            if waited > CHAT_QUEUE_MAX_WAIT:
+                inc_metric("bot_dropped_messages_total", reason="stale")
+                log.warning(f"🗑️ Сообщение в чате {chat_id} ждало {waited:.0f} сек, выброшено")
+                continue
+            PAYLOAD_SAMPLED.set(payload_sampled)
+            try:
+                await work()
+            except Exception as e:
+                log.exception(f"Chat queue error: {e}")
+    finally:
+        # Очередь пуста: освобождаем память неактивного чата
+        if not queue:
+            CHAT_QUEUES.pop(chat_id, None)
+        CHAT_WORKERS.pop(chat_id, None)
+
+async def handle_addressed_message(message: Message, bot_user: types.User):
+    """Полная обработка адресованного боту сообщения: фото, генерация, озвучка."""
+    # Задача очереди чата общая для его сообщений - привязываем лог к текущему
+    bind_request(message.chat.id, message.message_id)
+    with trace_request("message", chat_id=message.chat.id, photo=bool(message.photo or message.sticker)):
+        await bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
+        
+        try:
+            text_content = ""
+            if message.text:
+                text_content = strip_bot_mention(message.text)
+            elif message.caption:
+                text_content = strip_bot_mention(message.caption)
+            
+            log.info("📨 Сообщение боту")
+            log_payload("📨 Текст", text_content)
+            
+            with trace_span("prepare_prompt_parts"):
+                prompt_parts, temp_files_to_delete, image_key = await prepare_prompt_parts(message, bot_user)
+            
+            if not prompt_parts:
+                return
+            
+            await process_with_retry(message, bot_user, text_content, prompt_parts, temp_files_to_delete,
+                                     image_key=image_key)
+        
+        except Exception as e:
+            log.exception(f"Error: {e}")
+            await message.reply("❌ Ошибка")
+
 # --- ГЛАВНЫЙ ХЕНДЛЕР (ПОСЛЕДНИЙ!) ---
 @dp.message()
 async def main_handler(message: Message):
-    global ACTIVE_MODEL, ACTIVE_MODEL_NAME
-    
     # 🔍 СКРЫТЫЙ МОНИТОРИНГ: Проверяем, не один ли из отслеживаемых пользователей
     for user_name, user_data in MONITORED_USERS.items():
         if message.from_user.id == user_data["id"]:
             # Собираем сообщение СКРЫТНО, БЕЗ ОТВЕТА
             text_to_save = message.text or message.caption or ""
             if text_to_save:
-                save_user_message(
+                await save_user_message(
                     user_name=user_name,
                     user_id=message.from_user.id,
                     username=user_data["username"],
@@ -935,18 +2993,7 @@ async def main_handler(message: Message):
                 )
             break
     
-    if not ACTIVE_MODEL:
-        status_msg = await message.answer("⏳ Загрузка...")
-        if not await find_best_working_model(silent=True):
-            if not await switch_api_key(silent=True):
-                await status_msg.edit_text("❌ Лимиты")
-                return
-        try:
-            await status_msg.delete()
-        except:
-            pass
-    
-    bot_user = await bot.get_me()
+    bot_user = BOT_USER or await init_bot_identity()
     
     # ✅ ПРОВЕРЯЕМ ТРИГГЕР-СЛОВА - ВЫЗЫВАЕМ /start!
     text_to_check = message.text or message.caption or ""
@@ -955,7 +3002,7 @@ async def main_handler(message: Message):
     
     # ✅ ЕСЛИ ТРИГГЕР - ВЫЗЫВАЕМ /start ВМЕСТО ОБЫЧНОГО ОТВЕТА!
     if is_triggered:
-        print(f"🔴 ТРИГГЕР АКТИВИРОВАН → Вызываем /start меню")
+        log.info(f"🔴 ТРИГГЕР АКТИВИРОВАН → Вызываем /start меню")
         await command_start_handler(message)
         return
     
@@ -963,42 +3010,131 @@ async def main_handler(message: Message):
     if not is_addressed:
         return
     
-    await bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
-    
-    try:
-        text_content = ""
-        if message.text:
-            text_content = message.text.replace(f"@{bot_user.username}", "").strip()
-        elif message.caption:
-            text_content = message.caption.replace(f"@{bot_user.username}", "").strip()
-        
-        print(f"\n📨 {text_content[:50]}...")
-        
-        prompt_parts, temp_files_to_delete = await prepare_prompt_parts(message, bot_user)
-        
-        if not prompt_parts:
+    if not has_working_model():
+        status_msg = await message.answer("⏳ Загрузка...")
+        if await acquire_route() is None:
+            await status_msg.edit_text("❌ Лимиты")
             return
-        
-        await process_with_retry(message, bot_user, text_content, prompt_parts, temp_files_to_delete)
+        try:
+            await status_msg.delete()
+        except:
+            pass
     
-    except Exception as e:
-        logging.error(f"Error: {e}")
-        await message.reply("❌ Ошибка")
+    enqueue_chat_work(message.chat.id, lambda: handle_addressed_message(message, bot_user))
 
 # --- SERVER ---
 @app.get("/")
 async def root():
     return {
         "status": "Alive",
-        "model": ACTIVE_MODEL_NAME,
-        "voice": VOICES[CURRENT_VOICE],
-        "mode": REGIME_NAMES.get(CURRENT_MODE, "Unknown"),
+        "model": next((entry["model"] for entry in KEY_POOL if is_key_healthy(entry)), "Searching..."),
+        "models": {f"API #{entry['index'] + 1}": entry["model"] for entry in KEY_POOL},
+        "routes": {
+            f"API #{key_index + 1} {model_name}": round(expected_answer_time(key_index, model_name), 2)
+            for key_index, model_name in ROUTE_STATS
+        },
+        "voice": VOICES[MODE_VOICES[DEFAULT_MODE]],
+        "mode": REGIME_NAMES.get(DEFAULT_MODE, "Unknown"),
+        "chats": len(CHAT_SETTINGS),
+        "history_chats": len(CHAT_HISTORY),
+        "role": BOT_ROLE,
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики процесса; у приёмника - ещё и последние снимки метрик воркеров."""
+    sources = [("", METRICS)]
+    if BOT_ROLE == "ingest":
+        for worker, snapshot in sorted((await state_items("metrics")).items()):
+            sources.append((_label_pair("worker", worker), snapshot))
+    return Response(content=render_metrics(sources), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/traces/slowest")
+async def traces_slowest(limit: int = TRACE_SLOWEST):
+    """Самые медленные трассы (TRACING=1): этапы и их длительность."""
+    traces = slowest_traces(limit)
+    if BOT_ROLE == "ingest":
+        for snapshot in (await state_items("traces")).values():
+            traces.extend(snapshot)
+        traces.sort(key=lambda trace: trace["duration_ms"], reverse=True)
+    return {"enabled": TRACING, "traces": traces[:limit]}
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+def drop_bad_webhook_payload(error: Exception) -> Dict:
+    """Битый апдейт: 200, иначе Telegram будет присылать его снова и снова."""
+    inc_metric("bot_dropped_messages_total", reason="bad_payload")
+    log.error(f"❌ Битый апдейт от webhook пропущен: {str(error)[:200]}")
+    return {"ok": True}
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    """Принимает апдейты от Telegram и кладёт их в ограниченную очередь."""
+    if not WEBHOOK_ACTIVE:
+        return Response(status_code=404)
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    
+    try:
+        payload = await request.json()
+    except ValueError as e:
+        return drop_bad_webhook_payload(e)
+    if BOT_ROLE == "ingest":
+        # Приёмник только раскладывает апдейты по воркерам
+        try:
+            await push_update(payload)
+        except Exception as e:
+            # Не 200: Telegram повторит доставку позже
+            log.warning(f"⚠️ Апдейт не записан в очередь: {e}")
+            return Response(status_code=503)
+        return {"ok": True}
+    
+    try:
+        update = types.Update.model_validate(payload, context={"bot": bot})
+    except ValueError as e:
+        return drop_bad_webhook_payload(e)
+    try:
+        WEBHOOK_QUEUE.put_nowait(update)
+    except asyncio.QueueFull:
+        # Не 200: Telegram повторит доставку позже
+        inc_metric("bot_dropped_messages_total", reason="webhook_queue_full")
+        log.warning(f"⚠️ Очередь webhook переполнена, апдейт {update.update_id} отклонён")
+        return Response(status_code=503)
+    return {"ok": True}
+
+async def webhook_worker():
+    """Передаёт апдейты из очереди webhook в диспетчер."""
+    while True:
+        update = await WEBHOOK_QUEUE.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            log.exception(f"Webhook update error: {e}")
+        finally:
+            WEBHOOK_QUEUE.task_done()
+
+async def start_webhook() -> bool:
+    """Регистрирует webhook на RENDER_URL и запускает обработчиков очереди."""
+    global WEBHOOK_ACTIVE
+    
+    webhook_url = f"{RENDER_URL.rstrip('/')}{WEBHOOK_PATH}"
+    try:
+        await bot.set_webhook(
+            url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True
+        )
+    except Exception as e:
+        log.warning(f"⚠️ Webhook не установлен ({e}), остаюсь на polling")
+        return False
+    
+    WEBHOOK_ACTIVE = True
+    log.info(f"🌐 Webhook: {webhook_url}")
+    return True
+
 async def keep_alive_ping():
     if not RENDER_URL:
         return
@@ -1012,31 +3148,171 @@ async def keep_alive_ping():
             pass
 
 async def start_bot():
-    global CURRENT_API_KEY_INDEX
-    for i, key in enumerate(GOOGLE_KEYS):
-        try:
-            genai.configure(api_key=key)
-            CURRENT_API_KEY_INDEX = i
-            print(f"✅ API #{i + 1}")
-            break
-        except:
-            pass
+    init_key_pool()
+    await init_bot_identity()
+    await asyncio.gather(
+        *(find_best_working_model(entry["index"]) for entry in KEY_POOL),
+        return_exceptions=True
+    )
+    
+    if WEBHOOK_MODE and RENDER_URL and await start_webhook():
+        await asyncio.gather(*(webhook_worker() for _ in range(WEBHOOK_WORKERS)))
+        return
     
-    await find_best_working_model()
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
 
+async def ingest_polling():
+    """Long polling в приёмнике: апдейты не обрабатываются, а уходят в очередь воркеров."""
+    await bot.delete_webhook(drop_pending_updates=True)
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            log.warning(f"⚠️ getUpdates: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            payload = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+            # offset сдвигаем только после записи: иначе Telegram апдейт уже не отдаст
+            while True:
+                try:
+                    await push_update(payload)
+                    break
+                except Exception as e:
+                    log.warning(f"⚠️ Апдейт {update.update_id} не записан в очередь, повторяю: {e}")
+                    await asyncio.sleep(1)
+            offset = update.update_id + 1
+
+async def consume_updates():
+    """Забирает апдейты своего воркера из общей очереди и отдаёт их обработчикам webhook_worker."""
+    while True:
+        try:
+            payloads = await asyncio.to_thread(STATE.claim_updates, WORKER_INDEX)
+        except Exception as e:
+            log.warning(f"⚠️ Очередь апдейтов недоступна: {e}")
+            payloads = []
+        if not payloads:
+            await asyncio.sleep(UPDATE_POLL_INTERVAL)
+            continue
+        for payload in payloads:
+            try:
+                update = types.Update.model_validate_json(payload, context={"bot": bot})
+            except ValueError as e:
+                inc_metric("bot_dropped_messages_total", reason="bad_payload")
+                log.error(f"❌ Битый апдейт в очереди пропущен: {e}")
+                continue
+            await WEBHOOK_QUEUE.put(update)
+
+async def worker_main():
+    """Процесс-обработчик: свои ключи/модели, апдейты - из общей очереди."""
+    global STATE
+    STATE = make_state_backend()
+    if STATE is None:
+        log.error("❌ Воркеру нужен STATE_DB")
+        return
+    log.info(f"🛠️ Воркер #{WORKER_INDEX} запущен (pid {os.getpid()})")
+    
+    init_key_pool()
+    await init_bot_identity()
+    # Модели ключей уже проверил приёмник: берём его результат и кулдауны, а не пингуем заново
+    await sync_quota_state()
+    await asyncio.gather(
+        *(find_best_working_model(entry["index"]) for entry in KEY_POOL),
+        return_exceptions=True
+    )
+    
+    tasks = [consume_updates(), settings_writer(), state_sync_loop()]
+    tasks += [webhook_worker() for _ in range(WEBHOOK_WORKERS)]
+    if WORKER_INDEX == 0:
+        tasks.append(send_daily_reports())  # отчёты - только из одного процесса
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await bot.session.close()
+
+def run_worker(worker_index: int):
+    """Точка входа дочернего процесса."""
+    global BOT_ROLE, WORKER_INDEX
+    BOT_ROLE = "worker"
+    WORKER_INDEX = worker_index
+    try:
+        asyncio.run(worker_main())
+    except KeyboardInterrupt:
+        pass
+
+def start_worker_process(worker_index: int) -> multiprocessing.Process:
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_worker, args=(worker_index,), name=f"bot-worker-{worker_index}", daemon=True
+    )
+    process.start()
+    return process
+
+async def supervise_workers():
+    """Запускает WORKERS процессов-обработчиков и перезапускает упавшие."""
+    processes = [start_worker_process(i) for i in range(WORKERS)]
+    try:
+        while True:
+            await asyncio.sleep(5)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    log.warning(f"⚠️ Воркер #{i} завершился (код {process.exitcode}), перезапуск")
+                    processes[i] = start_worker_process(i)
+    finally:
+        for process in processes:
+            process.terminate()
+
+async def probe_keys_for_workers():
+    """Один раз проверяет модели всех ключей до запуска воркеров: они берут готовый
+    результат из общего хранилища, и пинги на старте не умножаются на WORKERS."""
+    init_key_pool()
+    await asyncio.gather(
+        *(find_best_working_model(entry["index"]) for entry in KEY_POOL),
+        return_exceptions=True
+    )
+    # Досчитывающие пробы тоже попадают в список, а записи - в хранилище до старта воркеров
+    await asyncio.gather(*PROBE_TASKS, return_exceptions=True)
+    await asyncio.gather(*STATE_TASKS, return_exceptions=True)
+
+async def start_ingest():
+    """Приёмник апдейтов: webhook или long polling, без обработки."""
+    global STATE
+    STATE = make_state_backend()
+    if STATE is None:
+        log.error("❌ Приёмнику нужен STATE_DB")
+        return
+    log.info(f"📥 Приёмник апдейтов, воркеров: {WORKERS}, состояние: {STATE_BACKEND} {STATE_DB}")
+    await probe_keys_for_workers()
+    
+    if WEBHOOK_MODE and RENDER_URL and await start_webhook():
+        await supervise_workers()
+        return
+    await asyncio.gather(supervise_workers(), ingest_polling())
+
 async def start_server():
     config = uvicorn.Config(app, host="0.0.0.0", port=10000, log_level="error")
     server = uvicorn.Server(config)
     await server.serve()
 
 async def main():
+    global STATE
+    if BOT_ROLE == "worker":
+        await worker_main()
+        return
+    if BOT_ROLE == "ingest":
+        await asyncio.gather(start_server(), start_ingest(), keep_alive_ping())
+        return
+    
+    STATE = make_state_backend()
     await asyncio.gather(
         start_server(), 
         start_bot(), 
         keep_alive_ping(),
-        send_daily_reports()
+        send_daily_reports(),
+        settings_writer(),
+        state_sync_loop()
     )
 
 if __name__ == "__main__":